@@ -0,0 +1,201 @@
+"""Check that a request to a self-hosted skill was sent by Alexa, as Alexa requires of endpoints other than Lambda.
+
+See https://developer.amazon.com/en-US/docs/alexa/custom-skills/host-a-custom-skill-as-a-web-service.html
+
+Alexa signs the body of each request with the key of a certificate for echo-api.amazon.com, and puts the signature
+(Signature-256, or Signature with SHA-1 from older senders) and the URL of the certificate chain
+(SignatureCertChainUrl, on s3.amazonaws.com under /echo.api/) in the request headers. RequestVerifier downloads
+the chain (once per URL), checks that it leads to a trusted root certificate and that the signing certificate is
+current and for echo-api.amazon.com, and checks the signature. The request's timestamp must also be within
+150 seconds, so a recorded request can't be replayed later.
+
+This module imports cryptography and aiohttp, so only server.py imports it.
+"""
+
+import base64
+import logging
+import posixpath
+import ssl
+from datetime import datetime, timezone
+from typing import Dict, List, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+
+logger = logging.getLogger(__name__)
+
+CERT_URL_HOST = 's3.amazonaws.com'
+CERT_URL_PATH = '/echo.api/'
+SIGNING_NAME = 'echo-api.amazon.com'
+# seconds a request's timestamp can differ from the time it is received
+MAX_REQUEST_AGE = 150
+# the largest certificate chain downloaded
+MAX_CHAIN_BYTES = 64 * 1024
+
+
+class VerificationError(Exception):
+    """The request can't be shown to come from Alexa"""
+
+
+def check_cert_url(url: str) -> None:
+    """Raise VerificationError unless the URL is where Alexa keeps its certificate chains"""
+    parts = urlsplit(url)
+    try:
+        port = parts.port
+    except ValueError:
+        raise VerificationError(f'Invalid certificate chain URL {url}') from None
+    path = posixpath.normpath(parts.path) if parts.path else ''
+    if (parts.scheme.lower() != 'https' or (parts.hostname or '').lower() != CERT_URL_HOST
+            or port not in (None, 443) or not path.startswith(CERT_URL_PATH)):
+        raise VerificationError(f'Certificate chain URL {url} is not an Alexa one')
+
+
+def check_timestamp(event: dict, now: Optional[datetime] = None) -> None:
+    """Raise VerificationError unless the request was sent within MAX_REQUEST_AGE seconds"""
+    timestamp = event.get('request', {}).get('timestamp', '')
+    try:
+        sent = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise VerificationError(f'Invalid request timestamp {timestamp!r}') from None
+    if sent.tzinfo is None:
+        sent = sent.replace(tzinfo=timezone.utc)
+    age = ((now or datetime.now(timezone.utc)) - sent).total_seconds()
+    if abs(age) > MAX_REQUEST_AGE:
+        raise VerificationError(f'Request timestamp {timestamp} is {age:.0f} seconds old')
+
+
+def validity(cert: x509.Certificate) -> Tuple[datetime, datetime]:
+    """Return when the certificate becomes valid and expires, in UTC"""
+    # the _utc properties are in cryptography 42 and later, and the older ones are deprecated there
+    if hasattr(cert, 'not_valid_after_utc'):
+        return cert.not_valid_before_utc, cert.not_valid_after_utc
+    return cert.not_valid_before.replace(tzinfo=timezone.utc), cert.not_valid_after.replace(tzinfo=timezone.utc)
+
+
+def is_ca(cert: x509.Certificate) -> bool:
+    try:
+        return cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+    except x509.ExtensionNotFound:
+        return False
+
+
+def is_issued_by(cert: x509.Certificate, issuer: x509.Certificate) -> bool:
+    """Return True if issuer signed cert"""
+    if cert.issuer != issuer.subject or not is_ca(issuer):
+        return False
+    key = issuer.public_key()
+    try:
+        if isinstance(key, rsa.RSAPublicKey):
+            key.verify(cert.signature, cert.tbs_certificate_bytes, padding.PKCS1v15(), cert.signature_hash_algorithm)
+        elif isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(cert.signature, cert.tbs_certificate_bytes, ec.ECDSA(cert.signature_hash_algorithm))
+        else:
+            return False
+    except InvalidSignature:
+        return False
+    return True
+
+
+def load_trusted_roots() -> List[x509.Certificate]:
+    """Return the root certificates the system trusts (from OpenSSL's default CA file)"""
+    context = ssl.create_default_context()
+    return [x509.load_der_x509_certificate(der) for der in context.get_ca_certs(binary_form=True)]
+
+
+class RequestVerifier:
+    """Checks the signatures of Alexa requests, caching the signing certificate of each chain URL"""
+
+    trusted_roots: Optional[List[x509.Certificate]]
+    # certificate chain URL -> signing certificate
+    certs: Dict[str, x509.Certificate]
+    http_session: Optional[ClientSession]
+
+    def __init__(self, trusted_roots: Optional[List[x509.Certificate]] = None):
+        self.trusted_roots = trusted_roots
+        self.certs = {}
+        self.http_session = None
+
+    async def verify(self, headers: Mapping[str, str], body: bytes, now: Optional[datetime] = None) -> None:
+        """Raise VerificationError unless the body was signed by Alexa"""
+        url = headers.get('SignatureCertChainUrl')
+        if headers.get('Signature-256'):
+            signature, algorithm = headers['Signature-256'], hashes.SHA256()
+        else:
+            signature, algorithm = headers.get('Signature'), hashes.SHA1()
+        if not url or not signature:
+            raise VerificationError('Request is not signed')
+        cert = await self.signing_cert(url, now or datetime.now(timezone.utc))
+        try:
+            cert.public_key().verify(base64.b64decode(signature), body, padding.PKCS1v15(), algorithm)
+        except (InvalidSignature, ValueError):
+            raise VerificationError('Request signature does not match') from None
+
+    async def signing_cert(self, url: str, now: datetime) -> x509.Certificate:
+        """Return the verified signing certificate of the chain at url"""
+        check_cert_url(url)
+        cert = self.certs.get(url)
+        if cert is None:
+            try:
+                chain = self.split_chain(await self.download(url))
+            except ValueError:
+                raise VerificationError('Certificate chain is not valid PEM') from None
+            cert = self.check_chain(chain, now)
+            self.certs[url] = cert
+        not_before, not_after = validity(cert)
+        if not not_before <= now <= not_after:
+            del self.certs[url]
+            raise VerificationError('Signing certificate has expired')
+        return cert
+
+    @staticmethod
+    def split_chain(data: bytes) -> List[x509.Certificate]:
+        """Load every certificate in a PEM file"""
+        end = b'-----END CERTIFICATE-----'
+        return [x509.load_pem_x509_certificate(block + end) for block in data.split(end) if block.strip()]
+
+    def check_chain(self, chain: List[x509.Certificate], now: datetime) -> x509.Certificate:
+        """Return the signing certificate (the first) if the chain is current and leads to a trusted root"""
+        if not chain:
+            raise VerificationError('Certificate chain is empty')
+        for cert in chain:
+            not_before, not_after = validity(cert)
+            if not not_before <= now <= not_after:
+                raise VerificationError(f'Certificate {cert.subject.rfc4514_string()} is not valid now')
+        for cert, issuer in zip(chain, chain[1:]):
+            if not is_issued_by(cert, issuer):
+                raise VerificationError(f'Certificate {cert.subject.rfc4514_string()} is not issued by the next one')
+        if self.trusted_roots is None:
+            self.trusted_roots = load_trusted_roots()
+        last = chain[-1]
+        if last not in self.trusted_roots and not any(is_issued_by(last, root) for root in self.trusted_roots):
+            raise VerificationError('Certificate chain does not lead to a trusted root')
+
+        cert = chain[0]
+        try:
+            names = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        except x509.ExtensionNotFound:
+            raise VerificationError('Signing certificate has no subject alternative names') from None
+        if SIGNING_NAME not in names.get_values_for_type(x509.DNSName):
+            raise VerificationError(f'Signing certificate is not for {SIGNING_NAME}')
+        return cert
+
+    async def download(self, url: str) -> bytes:
+        if self.http_session is None:
+            self.http_session = ClientSession(timeout=ClientTimeout(total=5))
+        try:
+            async with self.http_session.get(url, raise_for_status=True) as response:
+                data = await response.content.read(MAX_CHAIN_BYTES + 1)
+        except ClientError as e:
+            raise VerificationError(f'Failed to download the certificate chain: {e}') from e
+        if len(data) > MAX_CHAIN_BYTES:
+            raise VerificationError('Certificate chain is too large')
+        return data
+
+    async def close(self) -> None:
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
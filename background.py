@@ -0,0 +1,306 @@
+"""Work done between requests, from a scheduled event on Lambda (see lambda_function.lambda_handler)
+or from background tasks in server.py: keeping logins warm (Warmer), alerting about doors left open
+(DoorMonitor) and sending scheduled commands (CommandScheduler).
+
+lambda_function imports this module only for scheduled events, so requests from Alexa don't.
+"""
+
+import asyncio
+import heapq
+import importlib
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from config import Settings, env
+from lambda_function import (CachedDoor, GarageRequestHandler, RequestBudget, describe_duration, import_network_stack,
+                             join_words, myq_clients, state_cache)
+from stores import CommandQueue, ScheduledCommand, get_command_queue
+
+logger = logging.getLogger()
+
+
+class DoorAlert(NamedTuple):
+    account: str
+    serial: str
+    name: str
+    # seconds the door has been open
+    open_for: float
+
+    def describe(self) -> str:
+        return f'{self.name} has been open for {describe_duration(self.open_for)}'
+
+
+class Notifier:
+    """Delivers the alerts of doors left open.
+
+    Each call has the alerts of one household (MyQ account) that came due together, to be sent as one message.
+    To send them somewhere, subclass Notifier and set NOTIFIER to module:ClassName.
+    """
+
+    async def notify(self, account: str, alerts: List[DoorAlert]) -> None:
+        raise NotImplementedError
+
+    @staticmethod
+    def message(alerts: List[DoorAlert]) -> str:
+        return join_words([alert.describe() for alert in alerts])
+
+
+class LogNotifier(Notifier):
+    """Logs alerts instead of sending them (NOTIFIER=log), and keeps them in sent, for trying out monitoring"""
+
+    # (account, alerts) of each notification
+    sent: List[Tuple[str, List[DoorAlert]]]
+
+    def __init__(self):
+        self.sent = []
+
+    async def notify(self, account: str, alerts: List[DoorAlert]) -> None:
+        self.sent.append((account, alerts))
+        logger.warning(f'{account}: {self.message(alerts)}')
+
+
+_notifier: Optional[Notifier] = None
+_notifier_loaded = False
+
+
+def get_notifier() -> Optional[Notifier]:
+    """Return the notifier set by NOTIFIER (log or module:ClassName), or None if alerts aren't sent"""
+    global _notifier, _notifier_loaded
+    if not _notifier_loaded:
+        _notifier_loaded = True
+        name = env.str('NOTIFIER', '')
+        if not name:
+            _notifier = None
+        elif name == 'log':
+            _notifier = LogNotifier()
+        else:
+            module_name, _, class_name = name.partition(':')
+            _notifier = getattr(importlib.import_module(module_name), class_name)()
+    return _notifier
+
+
+class DoorMonitor:
+    """Alerts households about doors left open longer than OPEN_ALERT_MINUTES (default 0, not monitored).
+
+    Warmer gives it each account's door states after fetching them with the warm login.
+    Only doors whose state changed are looked at: a door that opens gets a deadline, kept in a heap,
+    and a door that closes makes its deadline stale. So a check costs the changed doors and the alerts that are due,
+    not the number of households. A door is alerted about once each time it is left open,
+    and the alerts of a household that are due together are sent in one notification.
+    """
+
+    OPEN_STATES = ('open', 'opening', 'stopped')
+
+    # (account, serial number) -> time.monotonic() the door was first seen open, or None if it is closed
+    opened: Dict[Tuple[str, str], Optional[float]]
+    # door names by (account, serial number), for the alerts
+    names: Dict[Tuple[str, str], str]
+    # (deadline, account, serial number, opened) of doors that were open, with stale entries skipped when popped
+    deadlines: List[Tuple[float, str, str, float]]
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.opened = {}
+        self.names = {}
+        self.deadlines = []
+
+    @staticmethod
+    def enabled() -> bool:
+        return env.float('OPEN_ALERT_MINUTES', 0) > 0
+
+    def observe(self, account: str, doors: List[CachedDoor], now: Optional[float] = None) -> int:
+        """Record the account's door states and return how many doors changed"""
+        now = time.monotonic() if now is None else now
+        changed = 0
+        for door in doors:
+            key = (account, door.serial)
+            is_open = door.state in self.OPEN_STATES
+            was_open = self.opened.get(key) is not None
+            if key in self.opened and is_open == was_open:
+                continue
+            changed += 1
+            self.names[key] = door.name
+            self.opened[key] = now if is_open else None
+            if is_open:
+                heapq.heappush(self.deadlines, (now + env.float('OPEN_ALERT_MINUTES', 0) * 60, account,
+                                                door.serial, now))
+        return changed
+
+    def due(self, now: Optional[float] = None) -> Dict[str, List[DoorAlert]]:
+        """Remove the alerts that are due and return them by account"""
+        now = time.monotonic() if now is None else now
+        alerts: Dict[str, List[DoorAlert]] = {}
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, account, serial, opened = heapq.heappop(self.deadlines)
+            if self.opened.get((account, serial)) != opened:
+                # closed (and maybe opened again) since
+                continue
+            alerts.setdefault(account, []).append(DoorAlert(account, serial, self.names[account, serial],
+                                                            now - opened))
+        return alerts
+
+    async def check(self, now: Optional[float] = None) -> int:
+        """Send the alerts that are due, one notification per household, and return how many were sent"""
+        alerts = self.due(now)
+        notifier = get_notifier()
+        if not alerts or notifier is None:
+            return 0
+        results = await asyncio.gather(*(notifier.notify(account, account_alerts)
+                                         for account, account_alerts in alerts.items()), return_exceptions=True)
+        for account, result in zip(alerts, results):
+            if isinstance(result, Exception):
+                logger.warning(f'Failed to send alerts for {account}: {result!r}')
+        return sum(not isinstance(result, Exception) for result in results)
+
+
+door_monitor = DoorMonitor()
+
+
+def next_auto_close(at: str, now: Optional[float] = None, utc_offset: Optional[float] = None) -> datetime:
+    """Return the next time of day at (HH:MM) after now, in the time zone utc_offset hours from UTC
+    (default: the local time zone)"""
+    hour, _, minute = at.partition(':')
+    tz = None if utc_offset is None else timezone(timedelta(hours=utc_offset))
+    now_time = datetime.fromtimestamp(time.time() if now is None else now, tz)
+    close_time = now_time.replace(hour=int(hour), minute=int(minute or 0), second=0, microsecond=0)
+    return close_time if close_time > now_time else close_time + timedelta(days=1)
+
+
+class CommandScheduler:
+    """Sends the commands in the queue when they are due: closing a door in a few minutes (ScheduleCloseIntent)
+    and closing every door at AUTO_CLOSE_AT each day.
+
+    Run it from a scheduled event on Lambda (see lambda_function.lambda_handler)
+    or every COMMAND_INTERVAL seconds in server.py.
+    The due commands of each account are sent together with one MyQ login, and accounts are handled concurrently.
+    Doors are checked first, and a door that is already closed or closing isn't sent a command.
+    Commands that weren't sent because MyQ couldn't be reached are tried again at the next run, until they are
+    COMMAND_RETRY_WINDOW seconds late (default 3600).
+    """
+
+    async def run(self, accounts: Dict[str, Optional[Dict[str, Any]]], now: Optional[float] = None,
+                  context=None) -> int:
+        """Queue the accounts' next AUTO_CLOSE_AT and send their commands that are due, within the Lambda context's
+        time if there is one. accounts are user names and their settings (None for the environment).
+        Return the number of commands sent."""
+        queue = get_command_queue()
+        if queue is None:
+            return 0
+        now = time.time() if now is None else now
+        for user_name, settings in accounts.items():
+            self.queue_auto_close(queue, user_name, Settings(settings), now)
+        commands = queue.claim_due(list(accounts), now)
+        if not commands:
+            return 0
+        by_account: Dict[str, List[ScheduledCommand]] = {}
+        for command in commands:
+            by_account.setdefault(command.account, []).append(command)
+        results = await asyncio.gather(*(GarageRequestHandler(accounts[account]).run_commands(account_commands, context)
+                                         for account, account_commands in by_account.items()), return_exceptions=True)
+        sent = 0
+        due = {command.key: command.due for command in commands}
+        for account, statuses in zip(by_account, results):
+            if isinstance(statuses, Exception):
+                # the commands may have been sent, so they are left to their lease
+                logger.error(f'Failed to send scheduled commands for {account}', exc_info=statuses)
+                continue
+            for key, status in statuses.items():
+                if status == 'pending' and now - due[key] > env.float('COMMAND_RETRY_WINDOW', 3600):
+                    logger.warning(f'Scheduled command {key} could not be sent in time, giving up')
+                    status = 'failed'
+                queue.finish(key, status)
+                sent += status == 'sent'
+        return sent
+
+    @staticmethod
+    def queue_auto_close(queue: CommandQueue, user_name: str, settings: Settings, now: float) -> None:
+        at = settings.str('AUTO_CLOSE_AT', '')
+        if not at:
+            return
+        utc_offset = settings.str('UTC_OFFSET', '')
+        close_time = next_auto_close(at, now, float(utc_offset) if utc_offset else None)
+        # one per account and day, however often this runs
+        queue.add(ScheduledCommand(f'auto-close:{user_name}:{close_time.date().isoformat()}', user_name, 'all',
+                                   'close', close_time.timestamp()))
+
+
+command_scheduler = CommandScheduler()
+
+
+class Warmer:
+    """Keeps MyQ logins and door states fresh between requests, so requests by users take the warm path.
+
+    Run it from a scheduled event on Lambda (see lambda_function.lambda_handler)
+    or every WARM_INTERVAL seconds in server.py.
+    It imports the MyQ modules, logs in or refreshes tokens that expire within WARM_TOKEN_MARGIN seconds
+    (default 600), and fetches the door states. To spread the load on MyQ when there are several accounts, each waits
+    a random time of up to WARM_JITTER seconds (default 5) and at most WARM_CONCURRENCY accounts (default 4)
+    are refreshed at once. An account is refreshed at most once every WARM_MIN_INTERVAL seconds (default 60)
+    after a successful refresh.
+    On Lambda, the wait is cut short to leave the invocation time to log in and fetch the doors.
+    With OPEN_ALERT_MINUTES, the door states are then checked for doors left open (see DoorMonitor).
+    """
+
+    # user name -> time.monotonic() of the last refresh
+    last_warmed: Dict[str, float]
+
+    def __init__(self):
+        self.last_warmed = {}
+        self.random = random.Random()
+
+    async def warm(self, accounts: List[Tuple[str, str]], context=None) -> int:
+        """Refresh the accounts (user name and password) and return how many were refreshed.
+        With a Lambda context, the refreshes are given the invocation's remaining time."""
+        import_network_stack()
+        semaphore = asyncio.Semaphore(env.int('WARM_CONCURRENCY', 4))
+        # there is nothing to spread out with one account
+        jitter = env.float('WARM_JITTER', 5) if len(accounts) > 1 else 0.0
+        results = await asyncio.gather(*(self.warm_account(user_name, password, semaphore, jitter, context)
+                                         for user_name, password in accounts))
+        if door_monitor.enabled():
+            await door_monitor.check()
+        return sum(results)
+
+    async def warm_account(self, user_name: str, password: str, semaphore: asyncio.Semaphore, jitter: float = 0.0,
+                           context=None) -> bool:
+        min_interval = env.float('WARM_MIN_INTERVAL', 60)
+        last_warmed = self.last_warmed.get(user_name)
+        if last_warmed is not None and time.monotonic() - last_warmed < min_interval:
+            return False
+
+        if jitter:
+            if context is not None:
+                # leave the invocation time to log in and fetch the doors after waiting
+                budget = RequestBudget(context)
+                jitter = min(jitter, budget.remaining() - budget.timeout('login') - budget.timeout('devices'))
+            await asyncio.sleep(self.random.uniform(0, max(jitter, 0)))
+        async with semaphore:
+            client = await myq_clients.acquire(user_name)
+            try:
+                myq = await client.get(user_name, password, RequestBudget(context),
+                                       token_margin=env.float('WARM_TOKEN_MARGIN', 600))
+                state_cache.update_from(user_name, myq)
+                self.last_warmed[user_name] = time.monotonic()
+                if door_monitor.enabled():
+                    door_monitor.observe(user_name, state_cache.get_doors(user_name))
+                return True
+            except Exception as e:
+                logger.warning(f'Failed to refresh MyQ login: {e!r}')
+                return False
+            finally:
+                await myq_clients.release(client)
+
+
+warmer = Warmer()
+
+
+def reset() -> None:
+    """Forget the door states and set up the notifier from the environment again on next use"""
+    global _notifier_loaded
+    door_monitor.clear()
+    _notifier_loaded = False
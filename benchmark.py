@@ -0,0 +1,194 @@
+"""Benchmark lambda_handler end to end against the MyQ simulator.
+
+Replays events/*.json and event.json through lambda_handler and reports p50/p95/p99 latency per intent,
+both cold (nothing cached from earlier invocations) and warm (the same container answering again),
+along with the time the handler spent in each phase (from its metrics)
+and the time the simulated MyQ cloud spent on login, device and command requests.
+
+    python benchmark.py --iterations 20 --latency 0.05 --doors 2
+
+With --responses, it instead compares serializing responses with ResponseTemplates against building
+and serializing the response dict.
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+import timeit
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import lambda_function
+from lambda_function import GarageRequestHandler, ResponseTemplates, Speechlet, help_messages
+from myq_simulator import MyQSimulator, patch_pymyq
+
+PROJECT_DIR = Path(__file__).parent
+
+# Alexa request types that can be replayed
+REQUEST_TYPES = ('LaunchRequest', 'IntentRequest', 'SessionEndedRequest')
+
+
+def load_events(paths: List[Path] = ()) -> List[Tuple[str, dict]]:
+    """Return (name, event) for each event file, by default event.json and events/*.json.
+    Events without a valid request type (like the event.json template) are replayed as a LaunchRequest."""
+    events = []
+    for path in paths or [PROJECT_DIR / 'event.json', *sorted((PROJECT_DIR / 'events').glob('*.json'))]:
+        event = json.loads(path.read_text())
+        if event['request']['type'] not in REQUEST_TYPES:
+            event['request']['type'] = 'LaunchRequest'
+        events.append((event_name(event), event))
+    return events
+
+
+def event_name(event: dict) -> str:
+    request = event['request']
+    if request['type'] == 'IntentRequest':
+        return request['intent']['name']
+    return request['type']
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(values: List[float]) -> str:
+    return (f'{len(values):4d} {percentile(values, 50):8.1f} {percentile(values, 95):8.1f} '
+            f'{percentile(values, 99):8.1f}')
+
+
+class Benchmark:
+    """Runs the events against a simulator and collects latencies in ms"""
+
+    # (temperature, intent) -> latencies; (temperature, phase) -> handler or simulated MyQ time per invocation
+    latencies: Dict[Tuple[str, str], List[float]]
+    handler_phases: Dict[Tuple[str, str], List[float]]
+    phases: Dict[Tuple[str, str], List[float]]
+
+    def __init__(self, simulator: MyQSimulator):
+        self.simulator = simulator
+        self.latencies = defaultdict(list)
+        self.handler_phases = defaultdict(list)
+        self.phases = defaultdict(list)
+        self.metrics_records: List[dict] = []
+
+    def invoke(self, temperature: str, name: str, event: dict) -> None:
+        self.simulator.reset_timings()
+        self.metrics_records.clear()
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler(json.loads(json.dumps(event)))
+        self.latencies[temperature, name].append((time.perf_counter() - start) * 1000)
+        for record in self.metrics_records:
+            for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                self.handler_phases[temperature, metric['Name']].append(record[metric['Name']])
+        for phase, timings in self.simulator.timings.items():
+            self.phases[temperature, phase].append(sum(timings) * 1000)
+        if response['response']['card']['title'] == 'MyQ - Try again':
+            print(f'Warning: {name} failed: {response["response"]["outputSpeech"]["text"]}')
+
+    def run(self, events: List[Tuple[str, dict]], iterations: int) -> None:
+        loop = lambda_function.get_event_loop()
+        writer, metrics = lambda_function.metrics_writer, os.environ.get('METRICS')
+        lambda_function.metrics_writer = lambda line: self.metrics_records.append(json.loads(line))
+        os.environ['METRICS'] = 'Y'
+        try:
+            for _ in range(iterations):
+                for name, event in events:
+                    loop.run_until_complete(lambda_function.reset_caches())
+                    self.invoke('cold', name, event)
+                    self.invoke('warm', name, event)
+        finally:
+            lambda_function.metrics_writer = writer
+            if metrics is None:
+                del os.environ['METRICS']
+            else:
+                os.environ['METRICS'] = metrics
+            loop.run_until_complete(lambda_function.reset_caches())
+
+    def report(self) -> str:
+        lines = [f'{"":5} {"intent":28} {"n":>4} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}']
+        for (temperature, name), values in sorted(self.latencies.items()):
+            lines.append(f'{temperature:5} {name:28} {summarize(values)}')
+        # only invocations that ran a phase are counted in its percentiles
+        for title, phases in (('handler phase', self.handler_phases), ('MyQ phase (server time)', self.phases)):
+            lines.append('')
+            lines.append(f'{"":5} {title:28} {"n":>4} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+            for (temperature, phase), values in sorted(phases.items()):
+                lines.append(f'{temperature:5} {phase:28} {summarize(values)}')
+        return '\n'.join(lines)
+
+
+def sample_speechlets() -> List[Speechlet]:
+    """Responses like the ones the skill gives, some the same every time and some with a door's name"""
+    move_msg = help_messages(True, False).move
+    speechlets = [
+        Speechlet('Welcome', f'You can {move_msg}.'),
+        Speechlet('Check door status', 'Both doors are closed'),
+        Speechlet('Goodbye', 'Goodbye'),
+        Speechlet('Try again', f"I didn't understand that. You can say {move_msg}.", f'Ask me to {move_msg}.'),
+    ]
+    speechlets += [Speechlet('Close door', f'Ok, closing garage door {i} now') for i in range(50)]
+    return speechlets
+
+
+def benchmark_responses(iterations: int = 10000) -> Dict[str, float]:
+    """Return the microseconds per response of each way of serializing the sample responses"""
+    speechlets = sample_speechlets()
+    templates = ResponseTemplates(cache_size=0)
+    cached_templates = ResponseTemplates()
+
+    def build_dict():
+        for speechlet in speechlets:
+            json.dumps(GarageRequestHandler.build_response({}, speechlet)).encode()
+
+    def render():
+        for speechlet in speechlets:
+            templates.render(speechlet)
+
+    def render_cached():
+        for speechlet in speechlets:
+            cached_templates.render(speechlet)
+
+    results = {}
+    for name, func in (('dict + json.dumps', build_dict), ('templates', render), ('templates, cached', render_cached)):
+        seconds = min(timeit.repeat(func, number=max(iterations // len(speechlets), 1), repeat=3))
+        results[name] = seconds / (max(iterations // len(speechlets), 1) * len(speechlets)) * 1e6
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the skill against a simulated MyQ cloud')
+    parser.add_argument('events', nargs='*', type=Path, help='event files (default: event.json and events/*.json)')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--doors', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every MyQ response')
+    parser.add_argument('--jitter', type=float, default=0.02, help='up to this many seconds added at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of MyQ API requests that fail')
+    parser.add_argument('--token-ttl', type=float, default=3600, help='seconds before MyQ rejects a token')
+    parser.add_argument('--responses', action='store_true', help='benchmark serializing responses instead')
+    args = parser.parse_args()
+
+    if args.responses:
+        for name, us in benchmark_responses(args.iterations * 10000).items():
+            print(f'{name:20} {us:8.2f} us per response')
+        return
+
+    os.environ.update({'USER_NAME': 'benchmark@example.com', 'PASSWORD': 'benchmark', 'MYQ_USER_AGENT': 'benchmark'})
+    simulator = MyQSimulator(doors=args.doors, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate, token_ttl=args.token_ttl, seed=0)
+    base_url = simulator.start()
+    try:
+        with patch_pymyq(base_url):
+            benchmark = Benchmark(simulator)
+            benchmark.run(load_events(args.events), args.iterations)
+    finally:
+        simulator.stop()
+    print(benchmark.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""Build the Lambda deployment zip from the modules the skill actually imports, compiled to bytecode.
+
+Instead of copying site-packages and deleting what isn't needed, this imports lambda_function and the modules
+it imports when it first needs them (environs, myq_api with pymyq and aiohttp, background for scheduled events,
+and cryptography for the token store, if installed) in the target interpreter, and packages only the modules that
+were imported, as .pyc files without their sources. That is everything a request needs, and nothing has to be
+compiled when Lambda starts.
+
+The bytecode is compiled by the target interpreter, and extension modules are copied from its site-packages,
+so run this with a Python (--python) of the same version and platform as the Lambda runtime.
+
+The zip is then unpacked and imported from on its own (only the zip and the standard library on sys.path),
+which checks that nothing is missing, and its size and import time are compared with the budgets:
+
+    python build_lambda.py --output lambda-upload.zip --python python3.8
+
+With --layer, the dependencies go in a separate zip for a Lambda layer (under python/) and the function zip
+has only the skill's modules, so code changes upload a few KB. Both zips are importable with zipimport too,
+except for extension modules.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import import_profile
+
+PROJECT_DIR = Path(__file__).parent
+
+# imported by lambda_function on first use, so they are part of a request but not of import lambda_function
+# (background only for scheduled events)
+LAZY_IMPORTS = ('environs', 'myq_api', 'background')
+# imported only when a feature that needs them is enabled, and packaged if installed
+# (Fernet loads cryptography's OpenSSL backend when a cipher is created, not when it is imported)
+OPTIONAL_IMPORTS = ('cryptography.fernet', 'cryptography.hazmat.backends.openssl')
+
+# Run by the target interpreter: import the skill and print every module that was imported, with the
+# sys.path entry it came from. Modules of the standard library are left out, Lambda has them.
+# Also print the metadata (METADATA in .dist-info) of the distributions the modules come from,
+# which some packages read when they are imported (marshmallow reads its version).
+PROBE = '''
+import importlib, importlib.metadata, importlib.util, json, os, sys, sysconfig
+paths = sysconfig.get_paths()
+# in a virtualenv, platstdlib is in the virtualenv and lib-dynload is only next to stdlib
+stdlib = {os.path.realpath(path) for path in (paths['stdlib'], paths['platstdlib'],
+                                              os.path.join(paths['stdlib'], 'lib-dynload'),
+                                              os.path.join(paths['platstdlib'], 'lib-dynload'))}
+before = set(sys.modules)
+for name in %(imports)r:
+    importlib.import_module(name)
+for name in %(optional)r:
+    if importlib.util.find_spec(name.partition('.')[0]) is not None:
+        importlib.import_module(name)
+roots = sorted({os.path.realpath(entry or os.getcwd()) for entry in sys.path}, key=len, reverse=True)
+modules = {}
+for name in sorted(set(sys.modules) - before):
+    path = getattr(sys.modules[name], '__file__', None)
+    if not path:
+        continue
+    path = os.path.realpath(path)
+    root = next((root for root in roots if path.startswith(root + os.sep)), None)
+    if root is None or root in stdlib:
+        continue
+    modules[name] = {'path': path, 'root': root}
+packages = {module['path']: name.partition('.')[0] for name, module in modules.items()}
+metadata = []
+for dist in importlib.metadata.distributions():
+    files = [os.path.realpath(dist.locate_file(file)) for file in dist.files or ()]
+    covered = sorted({packages[path] for path in files if path in packages})
+    found = [path for path in files if path.endswith('.dist-info' + os.sep + 'METADATA')]
+    if covered and found:
+        root = next((root for root in roots if found[0].startswith(root + os.sep)), None)
+        if root is not None:
+            metadata.append({'path': found[0], 'root': root, 'packages': covered})
+print(json.dumps({'modules': modules, 'metadata': metadata}))
+'''
+
+# Run by the target interpreter: compile each source to sourceless bytecode
+COMPILE = '''
+import json, py_compile, sys
+optimize = int(sys.argv[1])
+for source, cfile, dfile in json.load(sys.stdin):
+    py_compile.compile(source, cfile=cfile, dfile=dfile, doraise=True, optimize=optimize,
+                       invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+'''
+
+# Budgets the build fails over. Set to what the current build needs plus some room, so a regression
+# (a new dependency, or an import that is no longer lazy) is noticed before it is deployed.
+MAX_SIZE_KB = 8000
+IMPORT_BUDGET_MS = 150
+REQUEST_IMPORT_BUDGET_MS = 400
+
+# timestamp of every zip entry, so the same modules always build the same zip
+ZIP_DATE = (2020, 1, 1, 0, 0, 0)
+
+
+class PackagedFile(NamedTuple):
+    source: Path
+    # path in the zip (relative to the zip's root or to python/ in a layer)
+    name: str
+    # True for the skill's own modules, False for dependencies
+    project: bool
+
+
+class BuildReport(NamedTuple):
+    files: int
+    size_kb: float
+    layer_size_kb: float
+    import_ms: float
+    request_import_ms: float
+
+    def format(self) -> str:
+        lines = [f'Files:             {self.files}',
+                 f'Zip size:          {self.size_kb:.0f} KB']
+        if self.layer_size_kb:
+            lines.append(f'Layer size:        {self.layer_size_kb:.0f} KB')
+        lines.append(f'Import (cold):     {self.import_ms:.1f} ms  lambda_function')
+        lines.append(f'Import (request):  {self.request_import_ms:.1f} ms  lambda_function, {", ".join(LAZY_IMPORTS)}')
+        return '\n'.join(lines)
+
+
+def import_closure(python: str = sys.executable, excludes: Sequence[str] = ()) -> List[PackagedFile]:
+    """Return the files of every module the skill imports, other than the standard library, leaving out the
+    top-level packages in excludes"""
+    code = PROBE % {'imports': ('lambda_function',) + LAZY_IMPORTS,
+                    'optional': tuple(name for name in OPTIONAL_IMPORTS if name.partition('.')[0] not in excludes)}
+    # EAGER_IMPORTS shouldn't change what is found
+    environment = {name: value for name, value in os.environ.items() if name != 'EAGER_IMPORTS'}
+    result = subprocess.run([python, '-c', code], capture_output=True, text=True, check=True, cwd=PROJECT_DIR,
+                            env=environment)
+    closure = json.loads(result.stdout)
+    project_dir = str(PROJECT_DIR.resolve())
+    files = []
+    for name, module in closure['modules'].items():
+        if name.partition('.')[0] in excludes:
+            continue
+        path = Path(module['path'])
+        files.append(PackagedFile(path, path.relative_to(module['root']).as_posix(), module['root'] == project_dir))
+    for metadata in closure['metadata']:
+        if all(package in excludes for package in metadata['packages']):
+            continue
+        path = Path(metadata['path'])
+        files.append(PackagedFile(path, path.relative_to(metadata['root']).as_posix(), False))
+    return files
+
+
+def compile_files(files: Sequence[PackagedFile], staging: Path, python: str = sys.executable,
+                  optimize: int = 0) -> None:
+    """Write each file to staging under its name in the zip: sources as .pyc, extension modules as they are"""
+    sources = []
+    for file in files:
+        target = staging / file.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if file.source.suffix == '.py':
+            sources.append((str(file.source), str(target.with_suffix('.pyc')), file.name))
+        else:
+            target.write_bytes(file.source.read_bytes())
+    subprocess.run([python, '-c', COMPILE, str(optimize)], input=json.dumps(sources), text=True, check=True)
+
+
+def packaged_name(file: PackagedFile) -> str:
+    return file.name[:-len('.py')] + '.pyc' if file.name.endswith('.py') else file.name
+
+
+def write_zip(path: Path, staging: Path, names: Sequence[str], prefix: str = '',
+              extra: Optional[Dict[str, Path]] = None) -> None:
+    """Write the staged files (and extra files, by name in the zip) to a reproducible zip"""
+    entries = {prefix + name: staging / name for name in names}
+    entries.update(extra or {})
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as zip_file:
+        for name in sorted(entries):
+            info = zipfile.ZipInfo(name, ZIP_DATE)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            zip_file.writestr(info, entries[name].read_bytes())
+
+
+def measure_imports(zips: Sequence[Path], python: str = sys.executable, runs: int = 3) -> Dict[str, float]:
+    """Unpack the zips into one directory, like Lambda does with a function and its layers, and return the best of
+    runs import times (ms) of lambda_function alone and with the modules a request imports.
+    Fails if anything the skill imports is missing from the zips."""
+    with tempfile.TemporaryDirectory() as directory:
+        for zip_path in zips:
+            with zipfile.ZipFile(zip_path) as zip_file:
+                zip_file.extractall(directory)
+        # a layer's modules are under python/, which Lambda puts on sys.path
+        layer_dir = Path(directory) / 'python'
+        if layer_dir.is_dir():
+            for path in layer_dir.iterdir():
+                path.rename(Path(directory) / path.name)
+        timings = {}
+        for key, modules in (('cold', 'lambda_function'), ('request', ', '.join(('lambda_function',) + LAZY_IMPORTS))):
+            timings[key] = min(import_profile.total_ms(import_profile.profile_imports(modules, python, directory))
+                               for _ in range(runs))
+        return timings
+
+
+def build(output: Path, python: str = sys.executable, layer: Optional[Path] = None, excludes: Sequence[str] = (),
+          dotenv: bool = True, optimize: int = 0, runs: int = 3) -> BuildReport:
+    files = import_closure(python, excludes)
+    with tempfile.TemporaryDirectory() as directory:
+        staging = Path(directory)
+        compile_files(files, staging, python, optimize)
+        project = [packaged_name(file) for file in files if file.project]
+        dependencies = [packaged_name(file) for file in files if not file.project]
+        extra = {'.env': PROJECT_DIR / '.env'} if dotenv and (PROJECT_DIR / '.env').exists() else {}
+        if layer:
+            write_zip(output, staging, project, extra=extra)
+            write_zip(layer, staging, dependencies, prefix='python/')
+        else:
+            write_zip(output, staging, project + dependencies, extra=extra)
+
+    zips = [output] + ([layer] if layer else [])
+    timings = measure_imports(zips, python, runs)
+    return BuildReport(files=len(files),
+                       size_kb=output.stat().st_size / 1024,
+                       layer_size_kb=layer.stat().st_size / 1024 if layer else 0.0,
+                       import_ms=timings['cold'],
+                       request_import_ms=timings['request'])
+
+
+def over_budget(report: BuildReport, max_size_kb: Optional[float] = None, budget_ms: Optional[float] = None,
+                request_budget_ms: Optional[float] = None) -> List[str]:
+    """Return a message for each budget the build is over"""
+    problems = []
+    size_kb = report.size_kb + report.layer_size_kb
+    if max_size_kb is not None and size_kb > max_size_kb:
+        problems.append(f'Zip size {size_kb:.0f} KB is over the budget of {max_size_kb:.0f} KB')
+    if budget_ms is not None and report.import_ms > budget_ms:
+        problems.append(f'Import time {report.import_ms:.1f} ms is over the budget of {budget_ms} ms')
+    if request_budget_ms is not None and report.request_import_ms > request_budget_ms:
+        problems.append(f'Request import time {report.request_import_ms:.1f} ms '
+                        f'is over the budget of {request_budget_ms} ms')
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Build the Lambda deployment zip from the modules the skill imports')
+    parser.add_argument('--output', type=Path, default=PROJECT_DIR / 'lambda-upload.zip')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter of the Lambda runtime version, with the requirements installed')
+    parser.add_argument('--layer', type=Path, help='put the dependencies in this zip, for a Lambda layer')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PACKAGE',
+                        help='leave out a top-level package (for example cryptography, without TOKEN_STORE)')
+    parser.add_argument('--no-env', dest='dotenv', action='store_false', help="don't add .env to the zip")
+    parser.add_argument('--optimize', type=int, choices=(0, 1, 2), default=0,
+                        help='bytecode optimization level (2 also removes docstrings)')
+    parser.add_argument('--runs', type=int, default=3, help='imports to time (the fastest is reported)')
+    parser.add_argument('--max-size-kb', type=float, default=MAX_SIZE_KB, help='fail if the zips are larger than this')
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS,
+                        help='fail if importing lambda_function takes longer than this')
+    parser.add_argument('--request-budget-ms', type=float, default=REQUEST_IMPORT_BUDGET_MS,
+                        help='fail if importing everything a request needs takes longer than this')
+    args = parser.parse_args()
+
+    report = build(args.output, args.python, args.layer, args.exclude, args.dotenv, args.optimize, args.runs)
+    print(f'Wrote {args.output}' + (f' and {args.layer}' if args.layer else ''))
+    print(report.format())
+    problems = over_budget(report, args.max_size_kb, args.budget_ms, args.request_budget_ms)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
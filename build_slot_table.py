@@ -0,0 +1,77 @@
+"""Generate slot_table.py from the slot types and intents in interaction_model.json.
+
+lambda_function looks up what the user said in the table, so resolving a slot is a dictionary lookup,
+and a value Alexa's entity resolution didn't match can still be found among the synonyms.
+Run this (or make slots) after changing interaction_model.json:
+
+    python build_slot_table.py
+"""
+
+import argparse
+import inspect
+import json
+from pathlib import Path
+from typing import Dict
+
+PROJECT_DIR = Path(__file__).parent
+
+DOCSTRING = ('"""Slot values and synonyms of interaction_model.json. '
+             '''Generated by build_slot_table.py, don't edit."""''')
+
+
+def normalize(value: str) -> str:
+    """Return what the user said in the form of the SLOT_VALUES keys"""
+    return ' '.join(value.lower().split())
+
+
+def build_tables(model: dict) -> Dict[str, dict]:
+    """Return the slot type of each intent's slots and, for each slot type, the ID of each value and synonym"""
+    language_model = model['interactionModel']['languageModel']
+    slot_values = {}
+    for slot_type in language_model['types']:
+        values = slot_values[slot_type['name']] = {}
+        for value in slot_type['values']:
+            name = value['name']
+            value_id = value.get('id') or name['value']
+            # a synonym shared by two values resolves to the first, like the first value listed
+            for spoken in (name['value'], *name.get('synonyms', ())):
+                values.setdefault(normalize(spoken), value_id)
+    intent_slots = {intent['name']: {slot['name']: slot['type'] for slot in intent['slots']}
+                    for intent in language_model['intents'] if intent.get('slots')}
+    return {'INTENT_SLOTS': intent_slots, 'SLOT_VALUES': slot_values}
+
+
+def format_table(name: str, table: Dict[str, dict], comment: str) -> str:
+    lines = [comment, f'{name} = {{']
+    for key, values in table.items():
+        if len(values) <= 2:
+            lines.append(f'    {key!r}: {values!r},')
+        else:
+            lines.append(f'    {key!r}: {{')
+            lines.extend(f'        {spoken!r}: {value_id!r},' for spoken, value_id in values.items())
+            lines.append('    },')
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def generate(model_path: Path = PROJECT_DIR / 'interaction_model.json') -> str:
+    """Return the source of slot_table.py"""
+    tables = build_tables(json.loads(model_path.read_text()))
+    # lambda_function normalizes what the user said the same way as the table
+    return '\n\n\n'.join([DOCSTRING, inspect.getsource(normalize)]) + '\n\n' + '\n\n'.join([
+        format_table('INTENT_SLOTS', tables['INTENT_SLOTS'], '# intent -> slot -> slot type'),
+        format_table('SLOT_VALUES', tables['SLOT_VALUES'], '# slot type -> normalized value or synonym -> value ID'),
+    ]) + '\n'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate slot_table.py from interaction_model.json')
+    parser.add_argument('--model', type=Path, default=PROJECT_DIR / 'interaction_model.json')
+    parser.add_argument('--output', type=Path, default=PROJECT_DIR / 'slot_table.py')
+    args = parser.parse_args()
+    args.output.write_text(generate(args.model))
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
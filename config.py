@@ -0,0 +1,56 @@
+"""Settings of the skill: the environment (and .env), and the settings of each account served by server.py"""
+
+import logging
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+# environs is a noticeable part of the cold start time, so it is imported when first needed.
+if TYPE_CHECKING:
+    from environs import Env
+
+logger = logging.getLogger()
+
+
+class LazyEnv:
+    """An environs Env that loads system env vars and reads .env on first use"""
+
+    _env: Optional['Env'] = None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._env is None:
+            from environs import Env
+            env_ = Env()
+            # set override=True for .env values to override existing vars
+            env_.read_env(override=False)
+            logger.setLevel(env_.log_level('LOG_LEVEL', logging.INFO))
+            self._env = env_
+        return getattr(self._env, name)
+
+
+env = LazyEnv()
+
+
+class Settings:
+    """An account's settings (USER_NAME, LEFT, ...) for a GarageRequestHandler.
+    Settings the account doesn't have come from the environment, which is all there is on Lambda."""
+
+    TRUE_VALUES = ('y', 'yes', 'true', 'on', '1')
+
+    values: Dict[str, Any]
+
+    def __init__(self, values: Optional[Dict[str, Any]] = None):
+        self.values = values or {}
+
+    def str(self, name: str, *default) -> str:
+        return str(self.values[name]) if name in self.values else env.str(name, *default)
+
+    def int(self, name: str, *default) -> int:
+        return int(self.values[name]) if name in self.values else env.int(name, *default)
+
+    def float(self, name: str, *default) -> float:
+        return float(self.values[name]) if name in self.values else env.float(name, *default)
+
+    def bool(self, name: str, *default) -> bool:
+        if name not in self.values:
+            return env.bool(name, *default)
+        value = self.values[name]
+        return value if isinstance(value, bool) else str(value).strip().lower() in self.TRUE_VALUES
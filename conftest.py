@@ -0,0 +1,121 @@
+"""Fixtures shared by the tests, and fakes of MyQ and of what Lambda and Alexa send"""
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import pytest
+from pymyq.garagedoor import MyQGaragedoor
+
+import lambda_function
+from myq_simulator import MyQSimulator, patch_pymyq
+
+
+@pytest.fixture()
+def event():
+    with Path('event.json').open() as f:
+        return json.load(f)
+
+
+@pytest.fixture(autouse=True)
+def reset_myq_client():
+    yield
+    lambda_function.get_event_loop().run_until_complete(lambda_function.reset_caches())
+
+
+class FakeMyQ:
+    """Stands in for an authenticated pymyq API without touching the network"""
+
+    def __init__(self, *door_states):
+        self.devices = {}
+        for i, door_state in enumerate(door_states):
+            serial = f'serial{i}'
+            self.devices[serial] = MyQGaragedoor(api=self, account='account', state_update=datetime.utcnow(),
+                                                 device_json={'serial_number': serial, 'name': f'Door {i}',
+                                                              'device_family': 'garagedoor',
+                                                              'state': {'door_state': door_state}})
+        self.device_order = []
+        self._security_token = ('Bearer token', datetime.utcnow() + timedelta(minutes=10), datetime.now())
+        self.authenticate = AsyncMock()
+        self.update_devices = AsyncMock()
+
+    @property
+    def covers(self):
+        return self.devices
+
+
+@pytest.fixture()
+def fake_login(mocker):
+    """Replace myq_api.login with one that returns a FakeMyQ with two closed doors"""
+    mocker.patch.dict(os.environ, {'USER_NAME': 'user', 'PASSWORD': 'password'})
+    return mocker.patch('myq_api.login', AsyncMock(side_effect=lambda *args, **kwargs: FakeMyQ('closed', 'closed')))
+
+
+@pytest.fixture()
+def simulator(mocker):
+    """Run the skill against a local MyQ simulator with two closed doors"""
+    mocker.patch.dict(os.environ, {'USER_NAME': 'user', 'PASSWORD': 'password', 'MYQ_USER_AGENT': 'test'})
+    simulator = MyQSimulator(doors=2, transition_time=0)
+    base_url = simulator.start()
+    with patch_pymyq(base_url):
+        yield simulator
+    lambda_function.get_event_loop().run_until_complete(lambda_function.reset_caches())
+    simulator.stop()
+
+
+class FakeContext:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class AlexaSigner:
+    """Signs requests like Alexa, with a certificate chain from a test root that the verifier trusts"""
+
+    CHAIN_URL = 'https://s3.amazonaws.com/echo.api/echo-api-cert.pem'
+
+    def __init__(self, signing_name='echo-api.amazon.com'):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        def make_cert(subject, key, issuer, issuer_key, ca, names=()):
+            now = datetime.now(timezone.utc)
+            builder = (x509.CertificateBuilder().subject_name(subject).issuer_name(issuer)
+                       .public_key(key.public_key()).serial_number(x509.random_serial_number())
+                       .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1))
+                       .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+            if names:
+                builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(n) for n in names]), False)
+            return builder.sign(issuer_key, hashes.SHA256())
+
+        root_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        root_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Test Root')])
+        self.root = make_cert(root_name, root_key, root_name, root_key, True)
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cert = make_cert(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, signing_name)]), self.key, root_name,
+                         root_key, False, [signing_name])
+        self.chain = b''.join(c.public_bytes(serialization.Encoding.PEM) for c in (cert, self.root))
+
+    def verifier(self, mocker):
+        from alexa_signature import RequestVerifier
+        verifier = RequestVerifier([self.root])
+        mocker.patch.object(verifier, 'download', AsyncMock(return_value=self.chain))
+        return verifier
+
+    def headers(self, body: bytes) -> dict:
+        import base64
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        signature = self.key.sign(body, padding.PKCS1v15(), hashes.SHA256())
+        return {'Signature-256': base64.b64encode(signature).decode(), 'SignatureCertChainUrl': self.CHAIN_URL}
+
+
+def signed_event(event):
+    event['request']['timestamp'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return json.dumps(event).encode()
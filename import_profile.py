@@ -0,0 +1,73 @@
+"""Report the import time of a module, as measured by python -X importtime.
+
+Run it before deploying to catch imports that slow down Lambda cold starts:
+
+    python import_profile.py lambda_function --budget-ms 150
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import List, NamedTuple, Optional
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def profile_imports(module: str = 'lambda_function', python: str = sys.executable,
+                    path: Optional[str] = None) -> List[ImportTime]:
+    """Import module (or several, separated by commas) in a fresh interpreter and return the time taken by each
+    import, in import order. With path, import only from that directory and the standard library, like Lambda
+    importing from an unpacked deployment zip."""
+    code = f'import {module}'
+    if path:
+        # Lambda puts the directory itself on sys.path rather than '' (which importlib.metadata can't search in 3.8)
+        code = f'import sys; sys.path[0] = {str(path)!r}; {code}'
+    args = [python, '-X', 'importtime'] + (['-S'] if path else []) + ['-c', code]
+    result = subprocess.run(args, capture_output=True, text=True, check=True, cwd=path)
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append(ImportTime(name.strip(), int(self_us), int(cumulative_us),
+                                (len(name) - len(name.lstrip())) // 2))
+    return times
+
+
+def total_ms(times: List[ImportTime]) -> float:
+    """Return the time to import everything, in ms"""
+    return sum(t.cumulative_us for t in times if t.depth == 0) / 1000
+
+
+def format_report(times: List[ImportTime], top: int = 20) -> str:
+    lines = [f'Total import time: {total_ms(times):.1f} ms ({len(times)} modules)',
+             f'{"self ms":>9} {"cumul ms":>9}  module']
+    for t in sorted(times, key=lambda t: t.cumulative_us, reverse=True)[:top]:
+        lines.append(f'{t.self_us / 1000:9.1f} {t.cumulative_us / 1000:9.1f}  {"  " * t.depth}{t.module}')
+    return '\n'.join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('module', nargs='?', default='lambda_function')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to measure with')
+    parser.add_argument('--top', type=int, default=20, help='number of slowest imports to list')
+    parser.add_argument('--budget-ms', type=float, help='fail if the import takes longer than this')
+    args = parser.parse_args()
+
+    times = profile_imports(args.module, args.python)
+    print(format_report(times, args.top))
+    if args.budget_ms is not None and total_ms(times) > args.budget_ms:
+        print(f'Import time is over the budget of {args.budget_ms} ms', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,25 +10,47 @@ See https://github.com/arraylabs/pymyq/blob/master/pymyq/device.py
 """
 
 import asyncio
+import contextlib
+import functools
+import json
 import logging
-from typing import TYPE_CHECKING
-
-import pymyq
-from aiohttp import ClientSession
-from environs import Env
-from pymyq.api import API
-
+import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import slot_table
+from config import Settings, env
+from resilience import CircuitBreaker, CircuitOpenError, SingleFlight, hedge_reads, retry_policy
+from stores import ScheduledCommand, get_command_queue, get_token_store, login_cipher
+
+# pymyq, aiohttp and environs (see config.LazyEnv) are most of the cold start time,
+# so they are imported when first needed.
 if TYPE_CHECKING:
+    from aiohttp import BaseConnector, ClientSession
+    from myq_api import ResumableAPI as API
     from pymyq.garagedoor import MyQGaragedoor
 
 VERSION = '1.0.6'
 
-# load system env vars and read .env (set override=True for .env values to override existing vars)
-env = Env()
-env.read_env(override=False)
-
 logger = logging.getLogger()
-logger.setLevel(env.log_level('LOG_LEVEL', logging.INFO))
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+
+def import_network_stack() -> None:
+    """Import the modules needed to talk to MyQ (done on the first request that needs them)"""
+    import aiohttp  # noqa: F401
+    import pymyq.api  # noqa: F401
+    import myq_api  # noqa: F401
+
+
+# Set EAGER_IMPORTS in the Lambda environment (not .env) to import everything at startup,
+# for example when provisioned concurrency makes initialization free.
+if os.environ.get('EAGER_IMPORTS', '').lower() in ('y', 'yes', 'true', '1'):
+    import_network_stack()
+    env.str('LOG_LEVEL', '')
 
 
 class InputException(Exception):
@@ -36,48 +58,681 @@ class InputException(Exception):
     pass
 
 
+def join_words(words: List[str]) -> str:
+    """Join words for speech: 'a', 'a and b', 'a, b and c'"""
+    if len(words) < 2:
+        return ''.join(words)
+    return f"{', '.join(words[:-1])} and {words[-1]}"
+
+
+def describe_duration(seconds: float) -> str:
+    """Return a duration like 'two minutes', to be spoken"""
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return 'a moment'
+    elif minutes == 1:
+        return 'a minute'
+    elif minutes < 60:
+        return f'{minutes} minutes'
+    elif minutes < 120:
+        return 'an hour'
+    else:
+        return f'{minutes // 60} hours'
+
+
+def describe_age(seconds: float) -> str:
+    """Return how long ago something happened, like 'two minutes ago', to be spoken"""
+    return f'{describe_duration(seconds)} ago'
+
+
+class Metrics:
+    """Timings of the phases of one request, written as a CloudWatch Embedded Metric Format (EMF) record.
+
+    Enable with METRICS=Y. When disabled, phase() returns a shared no-op context manager,
+    so the instrumentation costs next to nothing.
+    """
+
+    NO_OP = contextlib.nullcontext()
+
+    enabled: bool
+    # phase -> ms
+    timings: Dict[str, float]
+    properties: Dict[str, Any]
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.timings = {}
+        self.properties = {}
+
+    def phase(self, name: str):
+        """Return a context manager that times a phase"""
+        if not self.enabled:
+            return self.NO_OP
+        return PhaseTimer(self, name)
+
+    def record(self, name: str, ms: float) -> None:
+        # a phase that runs more than once (a command per door) runs concurrently, so keep the longest
+        self.timings[name] = max(self.timings.get(name, 0), ms)
+
+    def set(self, **properties) -> None:
+        """Add properties such as the intent name or whether a cache was hit"""
+        if self.enabled:
+            self.properties.update(properties)
+
+    def emit(self) -> None:
+        if not self.enabled:
+            return
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': env.str('METRICS_NAMESPACE', 'AlexaPyMyQ'),
+                    'Dimensions': [['Intent']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in self.timings],
+                }],
+            },
+            **self.properties,
+            **{name: round(ms, 2) for name, ms in self.timings.items()},
+        }
+        metrics_writer(json.dumps(record))
+
+
+class PhaseTimer:
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.metrics.record(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+# Lambda sends stdout to CloudWatch Logs, which extracts the metrics from EMF records.
+# (The logging module's prefix would stop CloudWatch from recognizing them.)
+metrics_writer = print
+
+
+class RequestBudget:
+    """The time left to answer an invocation, shared by the login, device fetch and command phases.
+
+    The deadline comes from the Lambda context (less BUDGET_RESERVE seconds to build and return the response)
+    or REQUEST_BUDGET seconds without one. Each phase is also capped by its own timeout and timed in metrics.
+    """
+
+    # phase -> (env var, default seconds)
+    PHASE_TIMEOUTS = {
+        'login': ('LOGIN_TIMEOUT', 4),
+        'refresh': ('REFRESH_TIMEOUT', 2),
+        'devices': ('DEVICES_TIMEOUT', 2),
+        'command': ('DOOR_COMMAND_TIMEOUT', 3),
+        'confirm': ('CONFIRM_TIMEOUT', 4),
+    }
+
+    deadline: float
+    metrics: Metrics
+
+    def __init__(self, context=None, metrics: Optional[Metrics] = None):
+        self.metrics = metrics or Metrics()
+        if context is not None:
+            remaining = context.get_remaining_time_in_millis() / 1000
+        else:
+            remaining = env.float('REQUEST_BUDGET', 5)
+        self.deadline = time.monotonic() + remaining - env.float('BUDGET_RESERVE', 0.3)
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.monotonic(), 0)
+
+    def timeout(self, phase: str) -> float:
+        name, default = self.PHASE_TIMEOUTS[phase]
+        return min(env.float(name, default), self.remaining())
+
+    async def run(self, phase: str, awaitable: Awaitable) -> Any:
+        """Await within the phase's timeout, raising asyncio.TimeoutError when it runs out.
+        The awaitable is cancelled on the timeout, so nothing is left running after the request is answered."""
+        with self.metrics.phase(phase):
+            return await asyncio.wait_for(awaitable, self.timeout(phase))
+
+
+class MyQClient:
+    """An authenticated MyQ API and its aiohttp session, kept alive across warm invocations.
+
+    Lambda reuses the module (and the event loop returned by get_event_loop) while the container is warm,
+    so a warm request can skip the TLS handshake and the OAuth login and go straight to the device state.
+    With a TokenStore, a cold start resumes the saved login instead.
+    """
+
+    myq: Optional['API']
+    http_session: Optional['ClientSession']
+    user_name: Optional[str]
+    loop: Optional[asyncio.AbstractEventLoop]
+    # concurrent requests share logins and refreshes (but never commands)
+    flights: SingleFlight
+    # returns the connection pool for the session (None for a session with its own)
+    get_connector: Optional[Callable[[], 'BaseConnector']]
+    # requests using the client
+    users: int
+    # stops logins and refreshes while MyQ is failing
+    breaker: CircuitBreaker
+    # the token that was last saved to the token store, and the cipher used
+    saved_token: Optional[str]
+    cipher: Any
+
+    def __init__(self, get_connector: Optional[Callable[[], 'BaseConnector']] = None):
+        self.flights = SingleFlight()
+        self.get_connector = get_connector
+        self.users = 0
+        self.breaker = CircuitBreaker()
+        self.reset()
+
+    @staticmethod
+    def is_stale_error(e: BaseException) -> bool:
+        """Return True if the error means the cached client can't be used any more and a cold login is needed"""
+        from pymyq.errors import AuthenticationError
+        # AuthenticationError is raised by pymyq when a 401 can't be fixed by re-authenticating,
+        # RuntimeError when the session or its event loop has been closed.
+        return isinstance(e, (AuthenticationError, RuntimeError))
+
+    def reset(self) -> None:
+        """Forget the cached client without closing it"""
+        self.myq = None
+        self.http_session = None
+        self.user_name = None
+        self.loop = None
+        self.saved_token = None
+        self.cipher = None
+
+    def is_warm(self, user_name: str) -> bool:
+        """Return True if there is a usable client for user_name on the running event loop"""
+        return (self.myq is not None
+                and self.user_name == user_name
+                and self.loop is asyncio.get_running_loop()
+                and not self.http_session.closed)
+
+    def token_expires_soon(self, margin: Optional[float] = None) -> bool:
+        """Return True if the token expires within margin seconds (default TOKEN_REFRESH_MARGIN)"""
+        # pymyq keeps (token, expiration, last refresh) and only refreshes once the token has expired
+        expiration = self.myq._security_token[1]
+        margin = timedelta(seconds=env.int('TOKEN_REFRESH_MARGIN', 60) if margin is None else margin)
+        return expiration is None or expiration - margin <= datetime.utcnow()
+
+    async def get(self, user_name: str, password: str, budget: RequestBudget,
+                  token_margin: Optional[float] = None) -> 'API':
+        """Return an authenticated API with up-to-date devices, logging in only if there's no warm client
+        and refreshing the token if it expires within token_margin seconds.
+        Raise CircuitOpenError without calling MyQ if it has been failing."""
+        if not self.breaker.allow():
+            budget.metrics.set(Breaker=self.breaker.state)
+            raise CircuitOpenError(f'MyQ circuit breaker is {self.breaker.state}')
+        start = time.monotonic()
+        try:
+            myq, login_seconds = await self.connect(user_name, password, budget, token_margin)
+        except (Exception, asyncio.CancelledError) as e:
+            # a cancelled probe opens the breaker again rather than leaving it half-open
+            self.breaker.record(time.monotonic() - start, e)
+            raise
+        # a full login takes several requests, so only the other calls count towards BREAKER_SLOW
+        self.breaker.record(time.monotonic() - start - login_seconds)
+        return myq
+
+    async def connect(self, user_name: str, password: str, budget: RequestBudget,
+                      token_margin: Optional[float] = None) -> Tuple['API', float]:
+        """Return the API with up-to-date devices and the seconds spent logging in (0 for a warm client)"""
+        if self.is_warm(user_name):
+            try:
+                await budget.run('refresh', self.flights.do(('refresh', user_name),
+                                                            lambda: self.refresh(token_margin)))
+                await self.update_devices(user_name, budget)
+                budget.metrics.set(Login='warm')
+                logger.debug('Using warm MyQ client')
+                self.save_login()
+                return self.myq, 0.0
+            except Exception as e:
+                if not self.is_stale_error(e):
+                    raise
+                logger.warning('Cached MyQ client is no longer usable, logging in again', exc_info=True)
+
+        login_start = time.monotonic()
+        await budget.run('login', self.flights.do(('login', user_name), lambda: self.login(user_name, password)))
+        login_seconds = time.monotonic() - login_start
+        await self.update_devices(user_name, budget)
+        budget.metrics.set(Login='cold')
+        self.save_login()
+        return self.myq, login_seconds
+
+    async def refresh(self, token_margin: Optional[float] = None) -> None:
+        if self.token_expires_soon(token_margin):
+            logger.info('Refreshing MyQ token')
+            await self.myq.authenticate(wait=True)
+
+    async def update_devices(self, user_name: str, budget: RequestBudget) -> None:
+        """Fetch the door states, timed as their own phase apart from the login or token refresh"""
+        myq = self.myq
+        await budget.run('devices', self.flights.do(('devices', user_name), lambda: myq.update_devices()))
+
+    async def login(self, user_name: str, password: str) -> None:
+        """Resume the saved login or, if there isn't one or it's rejected, log in with the password"""
+        import myq_api
+        from aiohttp import ClientSession
+
+        await self.close()
+        logger.info('Logging in to MyQ')
+        connector = self.get_connector() if self.get_connector else None
+        self.http_session = ClientSession(connector=connector, connector_owner=connector is None)
+        self.loop = asyncio.get_running_loop()
+        try:
+            state = self.load_login(user_name, password)
+            # MYQ_USER_AGENT skips the request to GitHub for the user agent
+            self.myq = await myq_api.login(user_name, password, self.http_session,
+                                           env.str('MYQ_USER_AGENT', '') or None, state, retry_policy,
+                                           fetch_devices=False)
+        except BaseException:
+            # includes cancellation when the login runs out of time
+            await self.close()
+            raise
+        self.user_name = user_name
+        if state and self.myq._security_token[0] == state.get('token'):
+            self.saved_token = state['token']
+
+    def load_login(self, user_name: str, password: str) -> Optional[dict]:
+        """Return the saved login for the account, if any"""
+        store = get_token_store()
+        if store is None:
+            return None
+        from cryptography.fernet import InvalidToken
+
+        self.cipher = login_cipher(user_name, password)
+        data = store.load(user_name)
+        if data is None:
+            return None
+        try:
+            return json.loads(self.cipher.decrypt(data))
+        except InvalidToken:
+            logger.warning('Saved MyQ login could not be decrypted (the password or TOKEN_STORE_KEY changed?)')
+            store.delete(user_name)
+            return None
+
+    def save_login(self) -> None:
+        """Save the login if the token changed since it was last saved"""
+        store = get_token_store()
+        token = self.myq._security_token[0]
+        if store is None or self.cipher is None or token is None or token == self.saved_token:
+            return
+        try:
+            store.save(self.user_name, self.cipher.encrypt(json.dumps(self.myq.export_state()).encode()))
+            self.saved_token = token
+        except Exception:
+            # the login still works without saving it
+            logger.exception('Failed to save MyQ login')
+
+    async def close(self) -> None:
+        """Close the session (if it belongs to the running loop) and forget the client"""
+        if self.http_session is not None and not self.http_session.closed:
+            if self.loop is asyncio.get_running_loop():
+                await self.http_session.close()
+        self.reset()
+
+
+class CachedDoor(NamedTuple):
+    serial: str
+    name: str
+    state: str
+
+
+class DoorIndex:
+    """An account's doors in a stable order, found by serial number or name in O(1).
+
+    The skill numbers doors by position (LEFT and RIGHT default to the first two).
+    Doors keep the position they were first seen at, even if MyQ lists them in another order later,
+    and new doors are added at the end, in MyQ's order. Without a saved order (a cold start without
+    TOKEN_STORE), every door is new, so the doors are numbered in MyQ's order, as they always have been.
+    """
+
+    doors: List[CachedDoor]
+    # serial number or lower case name -> position
+    positions: Dict[str, int]
+
+    def __init__(self, doors: List[CachedDoor]):
+        self.doors = doors
+        self.positions = {}
+        for position, door in enumerate(doors):
+            self.positions.setdefault(door.name.lower(), position)
+        for position, door in enumerate(doors):
+            self.positions[door.serial] = position
+
+    @classmethod
+    def build(cls, covers: Dict[str, 'MyQGaragedoor'], order: List[str]) -> 'DoorIndex':
+        """Index the covers, keeping the doors in order (a list of serial numbers) where they were
+        and adding the others in MyQ's order"""
+        serials = [serial for serial in order if serial in covers]
+        serials += [serial for serial in covers if serial not in serials]
+        return cls([CachedDoor(serial, covers[serial].name, covers[serial].state) for serial in serials])
+
+    @property
+    def serials(self) -> List[str]:
+        return [door.serial for door in self.doors]
+
+    def position(self, key: str) -> Optional[int]:
+        """Return the position of the door with the serial number or name, if there is one"""
+        position = self.positions.get(key)
+        return position if position is not None else self.positions.get(key.strip().lower())
+
+    def set_state(self, serial: str, state: str) -> None:
+        position = self.positions.get(serial)
+        if position is not None:
+            self.doors[position] = self.doors[position]._replace(state=state)
+
+
+class DeviceStateCache:
+    """Door states by MyQ account and device serial number, so read-only intents can skip the device fetch.
+
+    Each account's doors are indexed by a DoorIndex, which also keeps the positions the skill numbers them by.
+    """
+
+    indexes: Dict[str, DoorIndex]
+    refreshed: Dict[str, float]
+    fetched: Dict[str, float]
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.indexes = {}
+        # account -> time.monotonic() of the last fetch from MyQ, unless it has been invalidated
+        self.refreshed = {}
+        # account -> time.monotonic() of the last fetch from MyQ
+        self.fetched = {}
+
+    def update(self, account: str, covers: Dict[str, 'MyQGaragedoor'], order: List[str] = ()) -> None:
+        """Replace the account's doors with freshly fetched covers.
+        Doors keep their positions from the last update or, after a cold start, from order (saved serial numbers)."""
+        index = self.indexes.get(account)
+        self.indexes[account] = DoorIndex.build(covers, index.serials if index else list(order))
+        self.refreshed[account] = self.fetched[account] = time.monotonic()
+
+    def update_from(self, account: str, myq: 'API') -> None:
+        """Update the account's doors from a freshly fetched API, giving it the door order to save with the login
+        (so doors keep their positions after a cold start)"""
+        self.update(account, myq.covers, myq.device_order)
+        myq.device_order = self.indexes[account].serials
+
+    def is_fresh(self, account: str, ttl: float) -> bool:
+        refreshed = self.refreshed.get(account)
+        return refreshed is not None and time.monotonic() - refreshed < ttl
+
+    def age(self, account: str) -> Optional[float]:
+        """Return the seconds since the account's doors were fetched, or None if they haven't been"""
+        fetched = self.fetched.get(account)
+        return None if fetched is None else time.monotonic() - fetched
+
+    def get_index(self, account: str) -> DoorIndex:
+        return self.indexes.get(account) or DoorIndex([])
+
+    def get_doors(self, account: str) -> List[CachedDoor]:
+        return self.get_index(account).doors
+
+    def set_state(self, account: str, serial: str, state: str) -> None:
+        """Optimistically record the state a command moves a door to (without extending the TTL)"""
+        index = self.indexes.get(account)
+        if index:
+            index.set_state(serial, state)
+
+    def invalidate(self, account: str) -> None:
+        self.refreshed.pop(account, None)
+
+
+class MyQClientPool:
+    """The MyQ clients of recently used accounts, so a server handling many households keeps them warm.
+
+    At most MYQ_CLIENTS (default 100) clients are kept; clients of other accounts are closed when they are
+    the least recently used and no request is using them.
+    Every client's session shares one pool of at most MYQ_CONNECTIONS (default 100) connections to MyQ.
+    """
+
+    clients: 'OrderedDict[str, MyQClient]'
+    connector: Optional['BaseConnector']
+    loop: Optional[asyncio.AbstractEventLoop]
+
+    def __init__(self):
+        self.clients = OrderedDict()
+        self.connector = None
+        self.loop = None
+
+    def get_connector(self) -> 'BaseConnector':
+        """Return the connection pool for the running event loop"""
+        from aiohttp import TCPConnector
+
+        if self.connector is None or self.connector.closed or self.loop is not asyncio.get_running_loop():
+            self.connector = TCPConnector(limit=env.int('MYQ_CONNECTIONS', 100))
+            self.loop = asyncio.get_running_loop()
+        return self.connector
+
+    async def acquire(self, user_name: str) -> MyQClient:
+        """Return the account's client (creating it if needed) for a request, which must release it"""
+        client = self.clients.pop(user_name, None) or MyQClient(self.get_connector)
+        # most recently used last
+        self.clients[user_name] = client
+        client.users += 1
+        await self.evict()
+        return client
+
+    async def release(self, client: MyQClient) -> None:
+        client.users -= 1
+        await self.evict()
+
+    async def evict(self) -> None:
+        """Close the least recently used idle clients beyond MYQ_CLIENTS"""
+        excess = len(self.clients) - env.int('MYQ_CLIENTS', 100)
+        idle = [user_name for user_name, client in self.clients.items() if not client.users][:max(excess, 0)]
+        for user_name in idle:
+            logger.debug('Closing least recently used MyQ client')
+            await self.clients.pop(user_name).close()
+
+    async def close(self) -> None:
+        for client in self.clients.values():
+            await client.close()
+        self.clients.clear()
+        if self.connector is not None and self.loop is asyncio.get_running_loop():
+            await self.connector.close()
+        self.connector = None
+        self.loop = None
+
+
+# shared by all invocations in this container
+myq_clients = MyQClientPool()
+state_cache = DeviceStateCache()
+
+
+async def reset_caches() -> None:
+    """Forget what is kept between invocations, as if the container had just started"""
+    import background
+    import stores
+
+    await myq_clients.close()
+    state_cache.clear()
+    stores.reset()
+    background.reset()
+
+
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop used for every invocation, so cached sessions stay bound to a live loop"""
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_event_loop)
+    return _event_loop
+
+
+class HelpMessages(NamedTuple):
+    move: str
+    check: str
+    check1: str
+
+
+@functools.lru_cache(maxsize=None)
+def help_messages(only_close: bool, one_door: bool) -> HelpMessages:
+    """Return the messages that tell users what they can say, which depend only on ONLY_CLOSE and the door count"""
+    move_msg = 'close the left or right door'
+    if not only_close:
+        move_msg = 'open or ' + move_msg
+    check_msg = "check the state of your garage door by asking what's up"
+    check1_msg = 'check the state of your garage door by asking if the left or right door is open'
+    if one_door:
+        move_msg = move_msg.replace(' left or right', '')
+        check_msg = check1_msg = check1_msg.replace(' left or right', '')
+    return HelpMessages(move_msg, check_msg, check1_msg)
+
+
+class Speechlet(NamedTuple):
+    """What the skill says: the card title, the speech (also the card's content), and the reprompt if it
+    expects an answer"""
+    title: str
+    output: str
+    reprompt_text: str = ''
+
+
+class ResponseTemplates:
+    """Serializes responses straight to JSON bytes, the same as json.dumps of GarageRequestHandler.build_response,
+    by filling the speechlet's text into JSON fragments computed once.
+
+    Whole responses are cached for recent speechlets. Most responses are one of a few, such as the welcome, help
+    and stop responses (which depend only on the intent, the door count and ONLY_CLOSE) or "Both doors are closed".
+    """
+
+    # placeholders for the speechlet's fields while computing the fragments
+    FIELDS = {'\x00title': 'title', '\x00output': 'output', '\x00reprompt': 'reprompt_text'}
+
+    # with and without a reprompt (which decides should_end_session) -> [(JSON fragment, field after it), ...]
+    templates: Dict[bool, List[Tuple[bytes, Optional[str]]]]
+    cache: 'OrderedDict[Speechlet, bytes]'
+
+    def __init__(self, cache_size: int = 256):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.templates = {has_reprompt: self.compile(has_reprompt) for has_reprompt in (False, True)}
+
+    def compile(self, has_reprompt: bool) -> List[Tuple[bytes, Optional[str]]]:
+        placeholders = Speechlet(*self.FIELDS)
+        if not has_reprompt:
+            placeholders = placeholders._replace(reprompt_text='')
+        sample = json.dumps(GarageRequestHandler.build_response({}, placeholders))
+        # the title is in the card as 'MyQ - {title}', so split around the placeholders rather than whole strings
+        pieces = re.split('(' + '|'.join(re.escape(json.dumps(name)[1:-1]) for name in self.FIELDS) + ')', sample)
+        template = []
+        for i in range(0, len(pieces) - 1, 2):
+            template.append((pieces[i].encode(), self.FIELDS[json.loads(f'"{pieces[i + 1]}"')]))
+        template.append((pieces[-1].encode(), None))
+        return template
+
+    def render(self, speechlet: Optional[Speechlet]) -> bytes:
+        if speechlet is None:
+            return json.dumps(GarageRequestHandler.build_response({}, None)).encode()
+        response = self.cache.get(speechlet)
+        if response is not None:
+            self.cache.move_to_end(speechlet)
+            return response
+        parts = []
+        for fragment, field in self.templates[bool(speechlet.reprompt_text)]:
+            parts.append(fragment)
+            if field:
+                # the JSON string without its quotes, which are in the fragments
+                parts.append(json.dumps(getattr(speechlet, field))[1:-1].encode())
+        response = b''.join(parts)
+        self.cache[speechlet] = response
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return response
+
+
 class GarageRequestHandler:
     """Handle a request by the garage skill"""
 
-    myq: API
+    myq: 'API'
 
     user_name: str
     password: str
 
-    # The order of the doors returned in the MyQ covers dictionary.
-    # Using order (while arbitrary) is simpler than specifying the names of the left and right doors.
-    left_door: int
-    right_door: int
+    # LEFT and RIGHT: the position (from 0) of the doors in the order MyQ first listed them, or their serial numbers
+    # or names in MyQ. Using order (while arbitrary) is simpler than specifying the names of the left and right doors.
+    left_setting: str
+    right_setting: str
 
     # By default, the skill will not open the door. Set env var NO_OPEN to 'No'
     only_close: bool
 
-    def __init__(self):
+    # Seconds that cached door states can answer read-only intents
+    state_cache_ttl: float
+
+    # Number of doors assumed before the doors have been fetched from MyQ
+    configured_door_count: int
+
+    # Wait for a door to finish moving after a command (within the time budget) and say where it got to
+    confirm_commands: bool
+
+    # Seconds between polls of a door's state while confirming a command, doubling up to the maximum
+    CONFIRM_POLL_FIRST = 0.25
+    CONFIRM_POLL_MAX = 2.0
+
+    # Most minutes ahead a door can be scheduled to close
+    MAX_SCHEDULE_MINUTES = 24 * 60
+
+    # Intents that only read door states
+    READ_ONLY_INTENTS = ('StateIntent', 'AllStatesIntent')
+
+    # Intents answered with static text
+    STATIC_INTENTS = ('AMAZON.HelpIntent', 'AMAZON.StopIntent', 'AMAZON.CancelIntent')
+
+    # Time left to answer the current request
+    budget: RequestBudget
+
+    # Timings of the current request
+    metrics: Metrics
+
+    # The account's settings, falling back to the environment
+    settings: Settings
+
+    # The account's MyQ client, leased from myq_clients for the current request
+    myq_client: 'MyQClient'
+
+    # Seconds since the door states were fetched, when MyQ is failing and they are used anyway
+    state_age: Optional[float] = None
+
+    # Alexa's ID of the current request, the same when a request is retried
+    request_id: Optional[str] = None
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        """settings override the environment, so a server can handle several accounts"""
+        self.settings = Settings(settings)
         self.validate_env()
 
-        # information messages that may be modified if there is only one door
-        self.move_msg = 'close the left or right door'
-        if not self.only_close:
-            self.move_msg = 'open or ' + self.move_msg
-        self.check_msg = "check the state of your garage door by asking what's up"
-        self.check1_msg = 'check the state of your garage door by asking if the left or right door is open'
+        # information messages that are changed if there is only one door
+        self.move_msg, self.check_msg, self.check1_msg = help_messages(self.only_close, False)
 
     def validate_env(self) -> None:
         """Make sure environment is set up correctly. Else raise an exception."""
         errors = []
 
-        self.user_name = env.str('USER_NAME')
+        self.user_name = self.settings.str('USER_NAME')
         if not self.user_name:
             errors.append('USER_NAME environment variable needs to be set to your MyQ user name')
 
-        self.password = env.str('PASSWORD')
+        self.password = self.settings.str('PASSWORD')
         if not self.password:
             errors.append('PASSWORD environment variable needs to be set to your MyQ password')
 
-        self.left_door = env.int('LEFT', 0)
-        self.right_door = env.int('RIGHT', 1 - self.left_door)
+        self.left_setting = self.settings.str('LEFT', '0')
+        self.right_setting = self.settings.str('RIGHT', '')
+
+        self.only_close = self.settings.bool('ONLY_CLOSE', True)
 
-        self.only_close = env.bool('ONLY_CLOSE', True)
+        self.state_cache_ttl = self.settings.float('STATE_CACHE_TTL', 10)
+        self.configured_door_count = self.settings.int('DOOR_COUNT', 2)
+        self.confirm_commands = self.settings.bool('CONFIRM_COMMANDS', False)
 
         if errors:
             raise Exception(','.join(errors))
@@ -86,20 +741,54 @@ class GarageRequestHandler:
     # 5882651c-6377-4bc7-bfd7-0fd661d95abc/entity-resolution-in-skill-builder
     @staticmethod
     def slot_value_id(intent, slot):
-        try:
-            return intent['slots'][slot]['resolutions']['resolutionsPerAuthority'][0]['values'][0]['value']['id']
-        except KeyError as e:
-            # if the input couldn't be parsed, there will be no values
-            if str(e) == "'values'":
-                raise InputException(slot) from None
-            else:
-                raise
+        """Return the ID of the slot's value: what the user said looked up in the values and synonyms of
+        interaction_model.json (slot_table), or else the value matched by Alexa's entity resolution"""
+        slot_json = intent['slots'][slot]
+        slot_type = slot_table.INTENT_SLOTS.get(intent['name'], {}).get(slot)
+        value_id = slot_table.SLOT_VALUES.get(slot_type, {}).get(slot_table.normalize(slot_json.get('value') or ''))
+        if value_id is not None:
+            return value_id
+        resolutions = slot_json.get('resolutions', {}).get('resolutionsPerAuthority') or [{}]
+        values = resolutions[0].get('values')
+        # if the input couldn't be parsed, there will be no values
+        if not values:
+            raise InputException(slot)
+        return values[0]['value']['id']
+
+    def door_count(self) -> int:
+        """Return the number of doors from the last device fetch, so help and launch don't need MyQ.
+        Before the first fetch, use DOOR_COUNT (doors are rarely added or removed)."""
+        doors = state_cache.get_doors(self.user_name)
+        return len(doors) if doors else self.configured_door_count
 
     def has_one_door(self):
-        return len(self.myq.covers) == 1
+        return self.door_count() == 1
+
+    def door_index(self) -> DoorIndex:
+        return state_cache.get_index(self.user_name)
 
     def get_door(self, device_ind: int) -> 'MyQGaragedoor':
-        return list(self.myq.covers.values())[device_ind]
+        return self.myq.covers[self.door_index().doors[device_ind].serial]
+
+    @property
+    def left_door(self) -> int:
+        return self.configured_door(self.left_setting, 0)
+
+    @property
+    def right_door(self) -> int:
+        return self.configured_door(self.right_setting, 1 - self.left_door)
+
+    def configured_door(self, setting: str, default: int) -> int:
+        """Return the position of the door set by LEFT or RIGHT"""
+        if not setting:
+            return default
+        if setting.isdigit():
+            return int(setting)
+        position = self.door_index().position(setting)
+        if position is None:
+            logger.warning(f'There is no door with the serial number or name {setting}')
+            return default
+        return position
 
     def get_door_index(self, door_name: str) -> int:
         """Convert a door name to an index"""
@@ -109,30 +798,102 @@ class GarageRequestHandler:
             return self.right_door
         elif door_name == 'both':
             return 0
-        else:
+        elif door_name.isdigit():
             return int(door_name) - 1
+        else:
+            position = self.door_index().position(door_name)
+            if position is None:
+                raise InputException(door_name)
+            return position
+
+    def door_name_id(self, intent: dict) -> str:
+        """Return the ID of the Name slot or, for a name the interaction model doesn't know
+        (like a door's name in the MyQ app), the name itself if a door has it"""
+        try:
+            return self.slot_value_id(intent, 'Name')
+        except InputException:
+            door_name = intent['slots']['Name'].get('value') or ''
+            if self.door_index().position(door_name) is None:
+                raise
+            return door_name
+
+    def as_of(self) -> str:
+        """Return how old the door states are, if they are old, to add to the answer"""
+        return '' if self.state_age is None else f' as of {describe_age(self.state_age)}'
 
     def status(self, device_ind: int) -> str:
-        door = self.get_door(device_ind)
+        door = state_cache.get_doors(self.user_name)[device_ind]
         logger.info(f'Check door state: {door.name} ({device_ind}) is {door.state}')
         return door.state
 
     async def open_door(self, device_ind: int) -> None:
         door = self.get_door(device_ind)
         logger.info(f'Change door state: {door.name} ({device_ind}) is {door.state}')
-        await door.open()
+        try:
+            wait_task = await door.open()
+        except (Exception, asyncio.CancelledError):
+            state_cache.invalidate(self.user_name)
+            raise
+        # pymyq returns a task that polls for 60 s; don't leave it running on the shared event loop
+        wait_task.cancel()
+        state_cache.set_state(self.user_name, door.device_id, 'opening')
 
     async def close_door(self, device_ind: int) -> None:
         door = self.get_door(device_ind)
         logger.info(f'Change door state: {door.name} ({device_ind}) is {door.state}')
-        await door.close()
+        try:
+            wait_task = await door.close()
+        except (Exception, asyncio.CancelledError):
+            state_cache.invalidate(self.user_name)
+            raise
+        wait_task.cancel()
+        state_cache.set_state(self.user_name, door.device_id, 'closing')
+
+    async def confirm_move(self, device_ind: int, command: str) -> str:
+        """Poll the door after a command until it is fully open or closed or the confirm phase runs out of time.
+        Return the last state MyQ reported."""
+        door = self.get_door(device_ind)
+        final_state = 'closed' if command == 'close' else 'open'
+        try:
+            await self.budget.run('confirm', self.poll_door(door, final_state))
+        except asyncio.TimeoutError:
+            pass
+        state = door.device_state
+        logger.info(f'Confirm door state: {door.name} ({device_ind}) is {state}')
+        state_cache.set_state(self.user_name, door.device_id, state)
+        return state
+
+    async def poll_door(self, door: 'MyQGaragedoor', final_state: str) -> None:
+        """Fetch the door's state, quickly at first and backing off, until it reaches final_state"""
+        from pymyq.errors import MyQError
+
+        interval = self.CONFIRM_POLL_FIRST
+        while door.device_state != final_state:
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.CONFIRM_POLL_MAX)
+            try:
+                await self.myq.update_device(door)
+            except MyQError as e:
+                # the command was accepted, so keep polling until time runs out
+                logger.warning(f'Failed to fetch the state of {door.name}: {e}')
+
+    @staticmethod
+    def confirmed_speech(door_name: str, command: str, state: str) -> str:
+        """Say where a door got to after a command"""
+        final_state, moving = ('closed', 'closing') if command == 'close' else ('open', 'opening')
+        if state == final_state:
+            return f'{door_name} is {final_state}'
+        elif state == moving:
+            return f'{door_name} is still {moving}'
+        else:
+            return f"I've sent the command to {command} {door_name}, but it hasn't started {moving} yet"
 
     # Called when the user launches the skill without specifying what they want.
-    def on_launch(self) -> dict:
+    def on_launch(self) -> Speechlet:
         return self.get_welcome_response()
 
     # Called when the user specifies an intent for this skill.
-    async def on_intent(self, intent: dict) -> dict:
+    async def on_intent(self, intent: dict) -> Speechlet:
         intent_name = intent['name']
         if intent_name == 'StateIntent':
             return self.execute_state_intent(intent)
@@ -143,6 +904,8 @@ class GarageRequestHandler:
                 return self.execute_all_states_intent()
         elif intent_name == 'MoveIntent':
             return await self.execute_move_intent(intent)
+        elif intent_name == 'ScheduleCloseIntent':
+            return self.execute_schedule_close_intent(intent)
         elif intent_name == 'AMAZON.HelpIntent':
             return self.get_welcome_response()
         elif intent_name in ('AMAZON.StopIntent', 'AMAZON.CancelIntent'):
@@ -153,16 +916,16 @@ class GarageRequestHandler:
     # Called when the user ends the session.
     # Is not called when the skill returns should_end_session=true.
     @staticmethod
-    def on_session_ended() -> dict:
+    def on_session_ended() -> None:
         # Add cleanup logic here
         logger.info('Session ended')
-        return {}
+        return None
 
-    def get_welcome_response(self) -> dict:
+    def get_welcome_response(self) -> Speechlet:
         speech_output = f'You can {self.move_msg}. You can also {self.check_msg}.'
         return self.build_speechlet_response('Welcome', speech_output)
 
-    async def execute_move_intent(self, intent: dict) -> dict:
+    async def execute_move_intent(self, intent: dict) -> Speechlet:
         # Ask garage {door|door 1|door 2} to {open|close|shut}
         #     "intent": {
         #       "name": "StateIntent",
@@ -183,7 +946,7 @@ class GarageRequestHandler:
 
         try:
             door_name = intent['slots']['Name']['value']
-            door_name_id = self.slot_value_id(intent, 'Name')
+            door_name_id = self.door_name_id(intent)
             door_action_id = self.slot_value_id(intent, 'Command')
 
             if door_name_id == 'both' and not self.has_one_door():
@@ -200,8 +963,17 @@ class GarageRequestHandler:
                 if door_state in ('closed', 'closing'):
                     speech_output = f'{door_name} is already {door_state}'
                 else:
-                    await self.close_door(device_ind)
-                    speech_output = f'Ok, closing {door_name} now'
+                    try:
+                        await self.budget.run('command', self.close_door(device_ind))
+                        if self.confirm_commands:
+                            door_state = await self.confirm_move(device_ind, 'close')
+                            speech_output = self.confirmed_speech(door_name, 'close', door_state)
+                        else:
+                            speech_output = f'Ok, closing {door_name} now'
+                    except asyncio.TimeoutError:
+                        logger.warning(f'Door {device_ind} did not accept close in time')
+                        speech_output = (f"Sorry, I couldn't send the command to close {door_name}, "
+                                         "MyQ didn't answer in time")
             else:
                 card_title = 'Open door'
                 if door_state in ('open', 'opening'):
@@ -210,8 +982,17 @@ class GarageRequestHandler:
                     speech_output = 'Sorry, I can only close the door'
                     card_title = 'Try again'
                 else:
-                    await self.open_door(device_ind)
-                    speech_output = f'Ok, opening {door_name} now'
+                    try:
+                        await self.budget.run('command', self.open_door(device_ind))
+                        if self.confirm_commands:
+                            door_state = await self.confirm_move(device_ind, 'open')
+                            speech_output = self.confirmed_speech(door_name, 'open', door_state)
+                        else:
+                            speech_output = f'Ok, opening {door_name} now'
+                    except asyncio.TimeoutError:
+                        logger.warning(f'Door {device_ind} did not accept open in time')
+                        speech_output = (f"Sorry, I couldn't send the command to open {door_name}, "
+                                         "MyQ didn't answer in time")
 
             return self.build_speechlet_response(card_title, speech_output)
 
@@ -219,55 +1000,143 @@ class GarageRequestHandler:
             logger.exception(f'Error executing {intent}')
             return self.build_speechlet_response('Try again', failure_msg, reprompt_msg)
 
-    async def execute_open_all_intent(self):
+    async def execute_open_all_intent(self) -> Speechlet:
         # Open all doors
+        return await self.execute_move_all_intent('open')
 
-        door_state_left = self.status(self.left_door)
-        door_state_right = self.status(self.right_door)
-
-        card_title = 'Open doors'
-
-        if door_state_left not in ['open', 'opening']:
-            await self.open_door(self.left_door)
-        if door_state_right not in ['open', 'opening']:
-            await self.open_door(self.right_door)
+    async def execute_close_all_intent(self) -> Speechlet:
+        # Close all doors
+        return await self.execute_move_all_intent('close')
 
-        if door_state_left not in ['open', 'opening'] and door_state_right not in ['open', 'opening']:
-            speech_output = 'Ok, opening both garage doors now'
-        elif door_state_left not in ['open', 'opening']:
-            speech_output = 'Ok, opening the left garage door now'
-        elif door_state_right not in ['open', 'opening']:
-            speech_output = 'Ok, opening the right garage door now'
+    async def execute_move_all_intent(self, command: str) -> Speechlet:
+        if command == 'close':
+            card_title = 'Close doors'
+            done_states, moving, failed_verb = ('closed', 'closing'), 'closing', 'close'
         else:
-            speech_output = 'Both doors are open'
+            card_title = 'Open doors'
+            done_states, moving, failed_verb = ('open', 'opening'), 'opening', 'open'
+
+        door_count = len(state_cache.get_doors(self.user_name))
+        all_doors = 'Both doors' if door_count == 2 else 'All doors'
+        to_move = [ind for ind in range(door_count) if self.status(ind) not in done_states]
+
+        if not to_move:
+            return self.build_speechlet_response(card_title, f'{all_doors} are {done_states[0]}')
+        if command == 'open' and self.only_close:
+            return self.build_speechlet_response('Try again', 'Sorry, I can only close the door')
+
+        moved, failed = await self.move_doors(command, to_move)
+
+        if len(moved) == door_count:
+            speech_output = f"Ok, {moving} {all_doors.lower().replace('doors', 'garage doors')} now"
+        elif moved:
+            speech_output = f'Ok, {moving} {join_words([self.door_label(ind) for ind in moved])} now'
+        elif failed:
+            speech_output = 'Sorry'
+        else:
+            speech_output = ''
+        if failed:
+            if moved:
+                speech_output += ', but'
+            speech_output += f" I couldn't {failed_verb} {join_words([self.door_label(ind) for ind in failed])}"
 
         return self.build_speechlet_response(card_title, speech_output)
 
-    async def execute_close_all_intent(self):
-        # Close all doors
-
-        door_state_left = self.status(self.left_door)
-        door_state_right = self.status(self.right_door)
-
-        card_title = 'Close doors'
-
-        if door_state_left not in ['closed', 'closing']:
-            await self.close_door(self.left_door)
-        if door_state_right not in ['closed', 'closing']:
-            await self.close_door(self.right_door)
-
-        if door_state_left not in ['closed', 'closing'] and door_state_right not in ['closed', 'closing']:
-            speech_output = 'Ok, closing both garage doors now'
-        elif door_state_left not in ['closed', 'closing']:
-            speech_output = 'Ok, closing the left garage door now'
-        elif door_state_right not in ['closed', 'closing']:
-            speech_output = 'Ok, closing the right garage door now'
+    def execute_schedule_close_intent(self, intent: dict) -> Speechlet:
+        # Ask garage to close {door|door 1|both doors} in {10} minutes
+        failure_msg = "I didn't understand that. You can say close the door in 10 minutes."
+        queue = get_command_queue()
+        if queue is None:
+            return self.build_speechlet_response('Try again', "Sorry, I can't close doors later")
+        try:
+            door_name = intent['slots']['Name']['value']
+            door_name_id = self.door_name_id(intent)
+            minutes = intent['slots'].get('Minutes', {}).get('value') or ''
+            if not minutes.isdigit() or not 0 < int(minutes) <= self.MAX_SCHEDULE_MINUTES:
+                raise InputException('Minutes')
+            if door_name_id == 'both' and not self.has_one_door():
+                door = 'all'
+            else:
+                door = self.door_index().doors[self.get_door_index(door_name_id)].serial
+        except (InputException, IndexError):
+            logger.exception(f'Error executing {intent}')
+            return self.build_speechlet_response('Try again', failure_msg, failure_msg)
+
+        due = time.time() + int(minutes) * 60
+        # a retried request has the same ID, so it doesn't schedule the command twice;
+        # without one, the same door and due minute is taken to be the same command
+        key = f'request:{self.request_id}' if self.request_id else f'close:{self.user_name}:{door}:{int(due // 60)}'
+        queue.add(ScheduledCommand(key, self.user_name, door, 'close', due))
+        minutes_text = 'a minute' if minutes == '1' else f'{minutes} minutes'
+        return self.build_speechlet_response('Close door later', f"Ok, I'll close {door_name} in {minutes_text}")
+
+    async def run_commands(self, commands: List[ScheduledCommand], context=None) -> Dict[str, str]:
+        """Send the account's scheduled commands with one MyQ login, skipping doors that are already closed or
+        closing, within the Lambda context's time if there is one. Return the status of each command by key:
+        sent, skipped, failed, or pending if it wasn't sent because MyQ couldn't be reached."""
+        self.metrics = Metrics(False)
+        self.budget = RequestBudget(context, self.metrics)
+        self.myq_client = await myq_clients.acquire(self.user_name)
+        try:
+            try:
+                self.myq = await self.myq_client.get(self.user_name, self.password, self.budget)
+            except Exception as e:
+                # nothing was sent, so the commands can be tried again
+                logger.warning(f'Failed to get door states to send scheduled commands: {e!r}')
+                return {command.key: 'pending' for command in commands}
+            state_cache.update_from(self.user_name, self.myq)
+            # one at a time, so a door closed by an earlier command is closing for the next
+            return {command.key: await self.run_command(command) for command in commands}
+        finally:
+            await myq_clients.release(self.myq_client)
+
+    async def run_command(self, command: ScheduledCommand) -> str:
+        index = self.door_index()
+        serials = index.serials if command.door == 'all' else [command.door]
+        positions = [index.position(serial) for serial in serials]
+        # checked against the states just fetched, so a door closed by hand isn't sent a command
+        door_inds = [ind for ind in positions if ind is not None and self.status(ind) not in ('closed', 'closing')]
+        if not door_inds:
+            logger.info(f'Scheduled {command.command} of {command.door} skipped, nothing to close')
+            return 'skipped'
+        _, failed = await self.move_doors(command.command, door_inds)
+        return 'failed' if failed else 'sent'
+
+    async def move_doors(self, command: str, door_inds: List[int]) -> Tuple[List[int], List[int]]:
+        """Send the command to the doors, giving each door the command phase timeout from when its command is sent.
+        Return the indexes of the doors that accepted the command and that failed or didn't answer in time
+        (their commands are cancelled, so none is sent after the request is answered)."""
+        move = self.close_door if command == 'close' else self.open_door
+        # pymyq sends one request at a time, so a door's timeout would otherwise run out while it waits for the others
+        turn = asyncio.Lock()
+
+        async def send(ind: int) -> None:
+            async with turn:
+                await self.budget.run('command', move(ind))
+
+        results = await asyncio.gather(*(send(ind) for ind in door_inds), return_exceptions=True)
+        moved, failed = [], []
+        for ind, result in zip(door_inds, results):
+            if isinstance(result, asyncio.TimeoutError):
+                logger.warning(f'Door {ind} did not accept {command} in time')
+                failed.append(ind)
+            elif isinstance(result, BaseException):
+                logger.error(f'Failed to {command} door {ind}', exc_info=result)
+                failed.append(ind)
+            else:
+                moved.append(ind)
+        return moved, failed
+
+    def door_label(self, device_ind: int) -> str:
+        """Return the spoken name of a door"""
+        if device_ind == self.left_door:
+            return 'the left garage door'
+        elif device_ind == self.right_door:
+            return 'the right garage door'
         else:
-            speech_output = 'Both doors are closed'
+            return f'garage door {device_ind + 1}'
 
-        return self.build_speechlet_response(card_title, speech_output)
-
-    def execute_state_intent(self, intent: dict) -> dict:
+    def execute_state_intent(self, intent: dict) -> Speechlet:
         # Ask garage if {door|door 1|door 2} is {open|up|closed|shut|down}
         #     'intent': {
         #       'name': 'StateIntent',
@@ -288,19 +1157,19 @@ class GarageRequestHandler:
 
         try:
             door_name = intent['slots']['Name']['value']
-            door_name_id = self.slot_value_id(intent, 'Name')
+            door_name_id = self.door_name_id(intent)
             device_ind = self.get_door_index(door_name_id)
             door_state = intent['slots']['State']['value']
             actual_door_state = self.status(device_ind)
 
             if not door_state:
-                speech_output = f'{door_name} is {actual_door_state}'
+                speech_output = f'{door_name} is {actual_door_state}{self.as_of()}'
             else:
                 door_state_id = self.slot_value_id(intent, 'State')
                 if door_state_id == actual_door_state:
-                    speech_output = f'Yes, {door_name} is {door_state}'
+                    speech_output = f'Yes, {door_name} is {door_state}{self.as_of()}'
                 else:
-                    speech_output = f'No, {door_name} is {actual_door_state}'
+                    speech_output = f'No, {door_name} is {actual_door_state}{self.as_of()}'
             card_title = 'Check door status'
 
             return self.build_speechlet_response(card_title, speech_output)
@@ -309,107 +1178,200 @@ class GarageRequestHandler:
             logger.exception(f'Error executing {intent}')
             return self.build_speechlet_response('Try again', failure_msg, reprompt_msg)
 
-    def execute_all_states_intent(self) -> dict:
+    def execute_all_states_intent(self) -> Speechlet:
         # Ask garage what's up
 
         door_state_left = self.status(self.left_door)
         door_state_right = self.status(self.right_door)
 
         if door_state_left == door_state_right:
-            speech_output = f'Both doors are {door_state_left}'
+            speech_output = f'Both doors are {door_state_left}{self.as_of()}'
         else:
-            speech_output = f'The left door is {door_state_left}, and the right door is {door_state_right}.'
+            speech_output = (f'The left door is {door_state_left}, and the right door is {door_state_right}'
+                             f'{self.as_of()}.')
         card_title = 'Check door status'
 
         return self.build_speechlet_response(card_title, speech_output)
 
-    def execute_state1_intent(self) -> dict:
+    def execute_state1_intent(self) -> Speechlet:
         # Ask garage what's up when there's one door
         door_state = self.status(0)
-        speech_output = f'The door is {door_state}.'
+        speech_output = f'The door is {door_state}{self.as_of()}.'
         card_title = 'Check door status'
         return self.build_speechlet_response(card_title, speech_output)
 
-    def execute_stop_intent(self) -> dict:
+    def execute_stop_intent(self) -> Speechlet:
         # Cancel or stop
         return self.build_speechlet_response('Goodbye', 'Goodbye')
 
     # --------------- Helpers that build all of the responses -----------------------
 
     @staticmethod
-    def build_speechlet_response(title: str, output: str, reprompt_text: str = '') -> dict:
+    def build_speechlet_response(title: str, output: str, reprompt_text: str = '') -> Speechlet:
         # If reprompt_text is available and the user either does not reply message or says something
         # that is not understood, they will be prompted again with the reprompt_text.
-        should_end_session = not reprompt_text
-        return {
-            'outputSpeech': {
-                'type': 'PlainText',
-                'text': output
-            },
-            'card': {
-                'type': 'Simple',
-                'title': f'MyQ - {title}',
-                'content': output
-            },
-            'reprompt': {
-                'outputSpeech': {
-                    'type': 'PlainText',
-                    'text': reprompt_text
-                }
-            },
-            'should_end_session': should_end_session
-        }
+        return Speechlet(title, output, reprompt_text)
 
     @staticmethod
-    def build_response(session_attributes, speechlet_response) -> dict:
+    def build_response(session_attributes, speechlet: Optional[Speechlet]) -> dict:
+        if speechlet is None:
+            # no response, like when the session has ended
+            return {'version': '1.0', 'session_attributes': session_attributes, 'response': {}}
+        should_end_session = not speechlet.reprompt_text
         return {
             'version': '1.0',
             'session_attributes': session_attributes,
-            'response': speechlet_response
+            'response': {
+                'outputSpeech': {
+                    'type': 'PlainText',
+                    'text': speechlet.output
+                },
+                'card': {
+                    'type': 'Simple',
+                    'title': f'MyQ - {speechlet.title}',
+                    'content': speechlet.output
+                },
+                'reprompt': {
+                    'outputSpeech': {
+                        'type': 'PlainText',
+                        'text': speechlet.reprompt_text
+                    }
+                },
+                'should_end_session': should_end_session
+            }
         }
 
-    async def process_with_session(self, event: dict, http_session: ClientSession) -> dict:
-        """Process the event and return a speechlet"""
-        self.myq = await pymyq.login(self.user_name, self.password, http_session)
+    def needs_myq(self, event: dict) -> bool:
+        """Return False for requests answered with static text, which don't need to import or call MyQ"""
+        request = event['request']
+        if request['type'] in ('LaunchRequest', 'SessionEndedRequest'):
+            return False
+        return not (request['type'] == 'IntentRequest' and request['intent']['name'] in self.STATIC_INTENTS)
+
+    def is_read_only(self, event: dict) -> bool:
+        request = event['request']
+        return request['type'] == 'IntentRequest' and request['intent']['name'] in self.READ_ONLY_INTENTS
+
+    async def process_with_session(self, event: dict) -> Optional[Speechlet]:
+        """Process the event with the shared MyQ session and return a speechlet"""
+        self.request_id = event['request'].get('requestId')
+        if not self.needs_myq(event):
+            logger.debug('Answering without MyQ')
+        elif self.is_read_only(event) and state_cache.is_fresh(self.user_name, self.state_cache_ttl):
+            logger.debug('Answering from cached door states')
+            self.metrics.set(StateCache='hit')
+        else:
+            self.metrics.set(StateCache='miss')
+            # a slow fetch for a question can be sent again (it is set only in this request's task)
+            hedge_reads.set(self.is_read_only(event))
+            try:
+                self.myq = await self.myq_client.get(self.user_name, self.password, self.budget)
+            except CircuitOpenError:
+                # MyQ has been failing: answer with the last known door states, saying how old they are
+                if not (self.is_read_only(event) and state_cache.get_doors(self.user_name)):
+                    raise
+                logger.info('Answering from old door states while MyQ is failing')
+                self.metrics.set(StateCache='stale')
+                self.state_age = state_cache.age(self.user_name)
+            else:
+                state_cache.update_from(self.user_name, self.myq)
+        self.metrics.set(DoorCount=self.door_count())
 
         if self.has_one_door():
-            self.move_msg = self.move_msg.replace(' left or right', '')
-            self.check_msg = self.check1_msg = self.check1_msg.replace(' left or right', '')
+            self.move_msg, self.check_msg, self.check1_msg = help_messages(self.only_close, True)
 
         if event['session']['new']:
             logger.info(f"New session: request_id={event['request']['requestId']}, " 
                         f"sessionId={event['session']['sessionId']}")
 
         request_type = event['request']['type']
-        if request_type == 'LaunchRequest':
-            return self.on_launch()
-        elif request_type == 'IntentRequest':
-            return await self.on_intent(event['request']['intent'])
-        elif request_type == 'SessionEndedRequest':
-            return self.on_session_ended()
-        else:
-            logger.error(f'Unknown request type: {request_type}')
-            raise InputException(request_type)
+        with self.metrics.phase('intent'):
+            if request_type == 'LaunchRequest':
+                return self.on_launch()
+            elif request_type == 'IntentRequest':
+                return await self.on_intent(event['request']['intent'])
+            elif request_type == 'SessionEndedRequest':
+                return self.on_session_ended()
+            else:
+                logger.error(f'Unknown request type: {request_type}')
+                raise InputException(request_type)
 
     # noinspection PyBroadException
-    async def process(self, event: dict) -> dict:
-        """Create the aiohttp session and run"""
+    async def process(self, event: dict, context=None, cold_start: bool = False,
+                      render: Optional[Callable[[Optional[Speechlet]], Any]] = None) -> Any:
+        """Run with the account's shared MyQ client within the time left in the Lambda context.
+        Return the response as a dict, or as rendered by render (like ResponseTemplates.render)."""
+        self.metrics = Metrics(env.bool('METRICS', False))
+        self.metrics.set(Intent=event['request'].get('intent', {}).get('name', event['request']['type']),
+                         ColdStart=cold_start)
+        self.budget = RequestBudget(context, self.metrics)
+        self.myq_client = await myq_clients.acquire(self.user_name)
         try:
-            async with ClientSession() as http_session:
-                speechlet = await self.process_with_session(event, http_session)
-        except Exception:
+            with self.metrics.phase('total'):
+                response = await self.process_with_metrics(event, render)
+        finally:
+            await myq_clients.release(self.myq_client)
+        self.metrics.emit()
+        return response
+
+    async def process_with_metrics(self, event: dict, render: Optional[Callable[[Optional[Speechlet]], Any]]) -> Any:
+        try:
+            speechlet = await self.process_with_session(event)
+        except CircuitOpenError:
+            logger.warning(f'Not executing {event} while MyQ is failing')
+            speechlet = self.build_speechlet_response('Try again', "Sorry. MyQ isn't responding right now. "
+                                                                   'Please try again in a few minutes')
+        except asyncio.TimeoutError:
+            logger.exception(f'Ran out of time executing {event}')
+            speechlet = self.build_speechlet_response('Try again', 'Sorry. MyQ is taking too long to respond. '
+                                                                   'Please try again in a moment')
+        except Exception as e:
             logger.exception(f'Error executing {event}')
+            if self.myq_client.is_stale_error(e):
+                # start the next request with a cold login
+                await self.myq_client.close()
             speechlet = self.build_speechlet_response('Try again', 'Sorry. There was an error processing your request')
 
-        # Not using sessions for now
-        session_attributes = {}
-
         # Return a response for speech output
-        return self.build_response(session_attributes, speechlet)
+        with self.metrics.phase('response'):
+            if render is not None:
+                return render(speechlet)
+            # Not using sessions for now
+            session_attributes = {}
+            return self.build_response(session_attributes, speechlet)
 
 
-def lambda_handler(event: dict, _context=None) -> dict:
+def is_scheduled_event(event: dict) -> bool:
+    """Return True for events from an EventBridge schedule (or {"warm": true}) rather than Alexa"""
+    return event.get('detail-type') == 'Scheduled Event' or bool(event.get('warm'))
+
+
+_cold_start = True
+
+
+def lambda_handler(event: dict, context=None) -> dict:
+    global _cold_start
     logger.info(f'Alexa-PyMyQ {VERSION}')
     logger.debug(f'Event: {event}')
+    cold_start, _cold_start = _cold_start, False
+    if is_scheduled_event(event):
+        from background import command_scheduler, warmer
+
+        settings = Settings()
+        user_name = settings.str('USER_NAME')
+        result = {}
+        try:
+            if get_command_queue() is not None:
+                # first, since they are due now
+                result['commands'] = get_event_loop().run_until_complete(
+                    command_scheduler.run({user_name: None}, context=context))
+        except Exception:
+            logger.exception('Failed to send scheduled commands')
+        try:
+            accounts = [(user_name, settings.str('PASSWORD'))]
+            result['warmed'] = get_event_loop().run_until_complete(warmer.warm(accounts, context))
+        except Exception:
+            logger.exception('Failed to refresh MyQ login')
+        return result
     handler = GarageRequestHandler()
-    return asyncio.get_event_loop().run_until_complete(handler.process(event))
+    return get_event_loop().run_until_complete(handler.process(event, context, cold_start))
@@ -0,0 +1,216 @@
+"""pymyq's API extended so a login can be saved and resumed, and a single device refreshed.
+
+pymyq asks MyQ for a refresh token (the offline_access scope) but doesn't keep it.
+ResumableAPI keeps it, exports the tokens and account IDs as a dict that can be saved,
+and when it has a refresh token, gets a new access token with one request instead of the whole OAuth login.
+It can also fetch the state of one door (to confirm a command) without listing every device on the account.
+With a retry policy (resilience.RetryPolicy), its requests are retried and hedged by the policy
+instead of by pymyq, and commands are sent only once.
+
+This module imports pymyq and aiohttp, so lambda_function imports it only when it needs to log in.
+"""
+
+import logging
+import string
+from datetime import datetime
+from random import choices
+from typing import Any, List, Optional, Tuple
+
+import pymyq.api
+from aiohttp import ClientResponse, ClientSession
+from aiohttp.client_exceptions import ClientError
+from pymyq.api import API, DEFAULT_TOKEN_REFRESH
+from pymyq.const import OAUTH_CLIENT_ID, OAUTH_CLIENT_SECRET
+from pymyq.device import MyQDevice
+from pymyq.errors import AuthenticationError, MyQError, RequestError
+from pymyq.request import MyQRequest
+
+logger = logging.getLogger(__name__)
+
+# where pymyq.login gets the user agent that MyQ accepts
+USER_AGENT_URL = 'https://raw.githubusercontent.com/arraylabs/pymyq/master/.USER_AGENT'
+
+
+class PolicyRequest(MyQRequest):
+    """pymyq's requests, sent once and retried by a retry policy rather than by pymyq"""
+
+    def __init__(self, websession: ClientSession, useragent: Optional[str], policy: Any):
+        super().__init__(websession, useragent)
+        self.policy = policy
+
+    async def _send_request(self, method: str, url: str, websession: ClientSession, headers: dict = None,
+                            params: dict = None, data: dict = None, json: dict = None,
+                            allow_redirects: bool = False) -> ClientResponse:
+        headers = dict(headers or {})
+        if self._useragent is not None:
+            headers['User-Agent'] = self._useragent
+
+        async def send() -> ClientResponse:
+            return await websession.request(method, url, headers=headers, params=params, data=data, json=json,
+                                            skip_auto_headers={'USER-AGENT'}, allow_redirects=allow_redirects,
+                                            raise_for_status=True)
+
+        # commands (PUT) move the door, so they are sent at most once; only fetches (GET) are hedged
+        return await self.policy.call(send, idempotent=method.lower() != 'put', hedge=method.lower() == 'get')
+
+
+class ResumableAPI(API):
+    """A pymyq API that keeps the refresh token and can export and import its login"""
+
+    refresh_token: Optional[str] = None
+    user_agent: Optional[str] = None
+    # serial numbers of the doors in the order the skill numbers them
+    device_order: List[str]
+
+    def __init__(self, username: str, password: str, websession: ClientSession = None, useragent: str = None,
+                 retry_policy: Any = None):
+        super().__init__(username, password, websession, useragent)
+        self.device_order = []
+        if retry_policy is not None:
+            self._myqrequests = PolicyRequest(self._myqrequests._websession, useragent, retry_policy)
+
+    async def request(self, method: str, returns: str, url: str, *args, **kwargs):
+        resp, data = await super().request(method, returns, url, *args, **kwargs)
+        # token responses come from the login and from refreshing
+        if url == pymyq.api.OAUTH_TOKEN_URI and isinstance(data, dict) and data.get('refresh_token'):
+            self.refresh_token = data['refresh_token']
+        return resp, data
+
+    async def _oauth_authenticate(self) -> Tuple[str, int]:
+        if self.refresh_token:
+            try:
+                return await self._refresh_authenticate()
+            except MyQError as e:
+                logger.info(f'MyQ refresh token was rejected, logging in again: {e}')
+                self.refresh_token = None
+        return await super()._oauth_authenticate()
+
+    async def _refresh_authenticate(self) -> Tuple[str, int]:
+        logger.debug('Refreshing MyQ token with the refresh token')
+        # Sent directly instead of through pymyq's request, which retries a rejected refresh token for seconds
+        # before the full login could start.
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if self.user_agent:
+            headers['User-Agent'] = self.user_agent
+        try:
+            async with self._myqrequests._websession.post(
+                    pymyq.api.OAUTH_TOKEN_URI,
+                    headers=headers,
+                    data={
+                        'client_id': OAUTH_CLIENT_ID,
+                        'client_secret': OAUTH_CLIENT_SECRET,
+                        'grant_type': 'refresh_token',
+                        'refresh_token': self.refresh_token,
+                        'scope': 'MyQ_Residential offline_access',
+                    },
+                    raise_for_status=True) as resp:
+                data = await resp.json()
+        except (ClientError, ValueError) as e:
+            raise AuthenticationError(f'Refreshing the token failed: {e}') from e
+        if not data.get('access_token'):
+            raise AuthenticationError('Refresh response did not contain an access token')
+        self.refresh_token = data.get('refresh_token') or self.refresh_token
+        # same expiration handling as pymyq's login
+        expires = max(int(data.get('expires_in', DEFAULT_TOKEN_REFRESH)), DEFAULT_TOKEN_REFRESH * 2)
+        return f"{data.get('token_type')} {data.get('access_token')}", expires
+
+    async def update_devices(self) -> None:
+        """Fetch every device now. pymyq's update_device_info skips a fetch within 10 s of the last one,
+        which would answer with old door states. With the accounts known, only their devices are fetched."""
+        if not self.accounts:
+            self.last_state_update = None
+            await self.update_device_info()
+            return
+        for account in list(self.accounts):
+            await self.update_device_info(for_account=account)
+        self.last_state_update = datetime.utcnow()
+
+    async def update_device(self, device: MyQDevice) -> None:
+        """Fetch the state of one device, rather than every device on the account like update_device_info"""
+        _, device_json = await self.request(
+            method='get',
+            returns='json',
+            url=f'{pymyq.api.DEVICES_ENDPOINT.format(account_id=device.account)}/{device.device_id}',
+        )
+        if not device_json or not device_json.get('state'):
+            raise RequestError(f'No state returned for device {device.device_id}')
+        last_update = device.device_json['state'].get('last_update')
+        device.device_json = device_json
+        # like update_device_info, drop the state pymyq set when sending a command once MyQ has a newer one
+        if device_json['state'].get('last_update') not in (None, last_update):
+            device.state = None
+        device.state_update = datetime.utcnow()
+
+    def export_state(self) -> dict:
+        """Return the login as a JSON-serializable dict"""
+        token, expiration, _ = self._security_token
+        return {
+            'token': token,
+            'expiration': expiration.isoformat() if expiration else None,
+            'refresh_token': self.refresh_token,
+            'user_agent': self.user_agent,
+            'accounts': self.accounts,
+            'devices': self.device_order or list(self.covers),
+        }
+
+    def import_state(self, state: dict) -> None:
+        """Resume a login exported by export_state"""
+        self.refresh_token = state.get('refresh_token')
+        expiration = datetime.fromisoformat(state['expiration']) if state.get('expiration') else None
+        if self.refresh_token or expiration is None or expiration <= datetime.utcnow():
+            # Make pymyq wait for a new token (from the refresh token) before its first request.
+            # Trying the saved token first doesn't save anything if it was revoked: pymyq retries a 401
+            # with the rejected token even after re-authenticating.
+            self._security_token = (None, None, None)
+        else:
+            self._security_token = (state['token'], expiration, None)
+        self.accounts = state.get('accounts') or {}
+        self.device_order = state.get('devices') or []
+
+
+async def get_user_agent(http_session: ClientSession) -> str:
+    """Return the user agent MyQ accepts, the way pymyq.login does"""
+    try:
+        async with http_session.get(USER_AGENT_URL) as resp:
+            resp.raise_for_status()
+            user_agent = await resp.text()
+    except ClientError as e:
+        logger.warning(f'Failed retrieving user agent from GitHub, using a random one: {e}')
+        user_agent = '#RANDOM:5'
+
+    user_agent = user_agent.strip()
+    if user_agent.startswith('#RANDOM'):
+        _, _, length = user_agent.partition(':')
+        user_agent = ''.join(choices(string.ascii_letters + string.digits, k=int(length) if length.isdigit() else 5))
+    return user_agent
+
+
+async def login(user_name: str, password: str, http_session: ClientSession, user_agent: Optional[str] = None,
+                state: Optional[dict] = None, retry_policy: Any = None, fetch_devices: bool = True) -> ResumableAPI:
+    """Log in to MyQ like pymyq.login, resuming a saved login (from export_state) if there is one.
+    If the saved tokens are rejected, fall back to the full login.
+    With retry_policy, requests are retried by it rather than by pymyq.
+    Without fetch_devices, only the access token is fetched, and the caller fetches the devices (update_devices)."""
+    user_agent = user_agent or (state or {}).get('user_agent') or await get_user_agent(http_session)
+
+    if state:
+        api = ResumableAPI(user_name, password, http_session, user_agent, retry_policy)
+        api.user_agent = user_agent
+        api.import_state(state)
+        try:
+            if fetch_devices:
+                await api.update_devices()
+            elif api._security_token[0] is None:
+                # what the first request would wait for, so a rejected refresh token falls back to the full login
+                await api.authenticate(wait=True)
+            logger.info('Resumed saved MyQ login')
+            return api
+        except MyQError as e:
+            logger.info(f'Saved MyQ login could not be resumed: {e}')
+
+    api = ResumableAPI(user_name, password, http_session, user_agent, retry_policy)
+    api.user_agent = user_agent
+    await api.authenticate(wait=True)
+    if fetch_devices:
+        await api.update_device_info()
+    return api
@@ -0,0 +1,333 @@
+"""A local stand-in for the MyQ cloud, so the skill can be tested and benchmarked without network or doors.
+
+It serves the endpoints pymyq uses: the OAuth login pages and token (including refresh tokens), accounts,
+devices and door commands.
+Latency, errors, token expiration and the number of doors are configurable.
+
+    simulator = MyQSimulator(doors=2, latency=0.05)
+    base_url = simulator.start()   # runs in a background thread
+    with patch_pymyq(base_url):
+        ...                        # pymyq now talks to the simulator
+    simulator.stop()
+
+Or run it on its own: python myq_simulator.py --port 8080 --doors 3
+"""
+
+import argparse
+import asyncio
+import contextlib
+import random
+import secrets
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set
+
+from aiohttp import web
+
+ACCOUNT_ID = 'simulated-account'
+
+LOGIN_FORM = """<html><body>
+<form method="post">
+<input type="hidden" name="__RequestVerificationToken" value="simulated">
+<input type="email" name="Email">
+<input type="password" name="Password">
+<input type="submit" value="Login">
+</form>
+</body></html>"""
+
+
+class SimulatedDoor:
+    """A door that takes transition_time seconds to open or close after a command"""
+
+    def __init__(self, serial: str, name: str, state: str, transition_time: float):
+        self.serial = serial
+        self.name = name
+        self.transition_time = transition_time
+        self._state = state
+        self._target: Optional[str] = None
+        self._moved_at = 0.0
+        self.last_update = datetime.utcnow().isoformat()
+
+    @property
+    def state(self) -> str:
+        if self._target and time.monotonic() - self._moved_at >= self.transition_time:
+            self._state, self._target = self._target, None
+            self.last_update = datetime.utcnow().isoformat()
+        return self._state
+
+    def command(self, command: str) -> None:
+        if command == 'close' and self.state not in ('closed', 'closing'):
+            self._state, self._target = 'closing', 'closed'
+        elif command == 'open' and self.state not in ('open', 'opening'):
+            self._state, self._target = 'opening', 'open'
+        else:
+            return
+        self._moved_at = time.monotonic()
+        self.last_update = datetime.utcnow().isoformat()
+
+    def device_json(self) -> dict:
+        return {
+            'serial_number': self.serial,
+            'device_family': 'garagedoor',
+            'device_platform': 'myq',
+            'device_type': 'wifigaragedooropener',
+            'name': self.name,
+            'parent_device_id': 'GW000000',
+            'state': {
+                'door_state': self.state,
+                'last_update': self.last_update,
+                'online': True,
+                'is_unattended_close_allowed': True,
+                'is_unattended_open_allowed': True,
+            },
+        }
+
+
+class MyQSimulator:
+    """Emulates the MyQ cloud endpoints that pymyq calls"""
+
+    # request group (reported as a phase) of each handler
+    LOGIN = 'login'
+    DEVICES = 'devices'
+    COMMAND = 'command'
+    HANDLER_GROUPS = {
+        'authorize_page': LOGIN,
+        'authorize_login': LOGIN,
+        'authorize_callback': LOGIN,
+        'token': LOGIN,
+        'accounts': DEVICES,
+        'devices': DEVICES,
+        'device': DEVICES,
+        'command': COMMAND,
+    }
+
+    def __init__(self, doors: int = 2, door_state: str = 'closed', latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, token_ttl: float = 3600, transition_time: float = 1.0,
+                 seed: Optional[int] = None):
+        """
+        :param doors: number of garage doors on the account
+        :param door_state: initial state of every door
+        :param latency: seconds added to every response
+        :param jitter: up to this many seconds added at random to every response
+        :param error_rate: fraction of API requests (not login pages) answered with a 500
+        :param token_ttl: seconds before an access token is rejected with a 401
+        :param transition_time: seconds a door takes to open or close
+        """
+        self.doors = {f'CG{i:08d}': SimulatedDoor(f'CG{i:08d}', f'Garage Door {i + 1}', door_state, transition_time)
+                      for i in range(doors)}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.tokens: Dict[str, float] = {}
+        self.refresh_tokens: Set[str] = set()
+        # the next this many API requests are answered with a 500, like a transient failure
+        self.failures = 0
+        # the next this many door commands are answered with a 500
+        self.command_failures = 0
+        self.full_logins = 0
+        self.token_refreshes = 0
+        # group -> seconds spent serving each request
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.commands: List[tuple] = []
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get('/connect/authorize', self.authorize_page)
+        app.router.add_post('/connect/authorize', self.authorize_login)
+        app.router.add_get('/connect/callback', self.authorize_callback)
+        app.router.add_post('/connect/token', self.token)
+        app.router.add_get('/api/v6.0/accounts', self.accounts)
+        app.router.add_get('/api/v5.2/Accounts/{account}/Devices', self.devices)
+        app.router.add_get('/api/v5.2/Accounts/{account}/Devices/{serial}', self.device)
+        app.router.add_put('/api/v5.2/Accounts/{account}/door_openers/{serial}/{command}', self.command)
+        return app
+
+    def reset_timings(self) -> None:
+        self.timings.clear()
+
+    def expire_tokens(self, refresh_tokens: bool = False) -> None:
+        """Make MyQ reject every access token (and optionally every refresh token) issued so far"""
+        self.tokens.clear()
+        if refresh_tokens:
+            self.refresh_tokens.clear()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        start = time.perf_counter()
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            return await handler(request)
+        finally:
+            group = self.HANDLER_GROUPS.get(getattr(handler, '__name__', ''))
+            if group:
+                self.timings[group].append(time.perf_counter() - start)
+
+    def _check(self, request: web.Request) -> None:
+        """Inject errors and reject missing or expired tokens"""
+        if self.failures:
+            self.failures -= 1
+            raise web.HTTPInternalServerError(text='Simulated error')
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise web.HTTPInternalServerError(text='Simulated error')
+        expires = self.tokens.get(request.headers.get('Authorization', ''))
+        if expires is None or expires <= time.monotonic():
+            raise web.HTTPUnauthorized(text='Invalid token')
+
+    # --------------- Login ---------------
+
+    async def authorize_page(self, _request: web.Request) -> web.Response:
+        return web.Response(text=LOGIN_FORM, content_type='text/html')
+
+    async def authorize_login(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        response = web.Response(status=302, headers={'Location': '/connect/callback'})
+        if form.get('Email') and form.get('Password'):
+            # pymyq treats fewer than two cookies as invalid credentials
+            response.set_cookie('.AspNetCore.Identity.Application', secrets.token_hex(8))
+            response.set_cookie('idsrv.session', secrets.token_hex(8))
+        return response
+
+    async def authorize_callback(self, _request: web.Request) -> web.Response:
+        return web.Response(status=302, headers={'Location': f'/ios?code={secrets.token_hex(8)}'})
+
+    async def token(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if form.get('grant_type') == 'refresh_token':
+            if form.get('refresh_token') not in self.refresh_tokens:
+                raise web.HTTPBadRequest(text='invalid_grant')
+            self.token_refreshes += 1
+        else:
+            self.full_logins += 1
+        access_token = secrets.token_hex(16)
+        refresh_token = secrets.token_hex(16)
+        self.tokens[f'Bearer {access_token}'] = time.monotonic() + self.token_ttl
+        self.refresh_tokens.add(refresh_token)
+        return web.json_response({'access_token': access_token, 'refresh_token': refresh_token,
+                                  'token_type': 'Bearer', 'expires_in': int(self.token_ttl)})
+
+    # --------------- API ---------------
+
+    async def accounts(self, request: web.Request) -> web.Response:
+        self._check(request)
+        return web.json_response({'accounts': [{'id': ACCOUNT_ID, 'name': 'Simulated'}]})
+
+    async def devices(self, request: web.Request) -> web.Response:
+        self._check(request)
+        return web.json_response({'items': [door.device_json() for door in self.doors.values()]})
+
+    async def device(self, request: web.Request) -> web.Response:
+        self._check(request)
+        door = self.doors.get(request.match_info['serial'])
+        if door is None:
+            raise web.HTTPNotFound()
+        return web.json_response(door.device_json())
+
+    async def command(self, request: web.Request) -> web.Response:
+        self._check(request)
+        if self.command_failures:
+            self.command_failures -= 1
+            raise web.HTTPInternalServerError(text='Simulated error')
+        door = self.doors.get(request.match_info['serial'])
+        if door is None:
+            raise web.HTTPNotFound()
+        command = request.match_info['command']
+        self.commands.append((door.serial, command))
+        door.command(command)
+        return web.Response(status=204)
+
+    # --------------- Running ---------------
+
+    async def start_async(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Serve on the running loop and return the base URL"""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f'http://{host}:{port}'
+
+    async def stop_async(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def start(self) -> str:
+        """Serve from a background thread (so the Lambda handler can run its own loop) and return the base URL"""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        result = {}
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            result['url'] = self._loop.run_until_complete(self.start_async())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='MyQSimulator', daemon=True)
+        self._thread.start()
+        started.wait()
+        return result['url']
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.stop_async(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._thread = None
+
+
+@contextlib.contextmanager
+def patch_pymyq(base_url: str) -> Iterator[None]:
+    """Point pymyq's endpoints at the simulator"""
+    import pymyq.api
+    import pymyq.garagedoor
+
+    patches = [
+        (pymyq.api, 'OAUTH_BASE_URI', base_url),
+        (pymyq.api, 'OAUTH_AUTHORIZE_URI', f'{base_url}/connect/authorize'),
+        (pymyq.api, 'OAUTH_TOKEN_URI', f'{base_url}/connect/token'),
+        (pymyq.api, 'ACCOUNTS_ENDPOINT', f'{base_url}/api/v6.0/accounts'),
+        (pymyq.api, 'DEVICES_ENDPOINT', base_url + '/api/v5.2/Accounts/{account_id}/Devices'),
+        (pymyq.garagedoor, 'COMMAND_URI',
+         base_url + '/api/v5.2/Accounts/{account_id}/door_openers/{device_serial}/{command}'),
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    for module, name, value in patches:
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in originals:
+            setattr(module, name, value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the MyQ cloud')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--doors', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds added at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API requests that fail')
+    parser.add_argument('--token-ttl', type=float, default=3600, help='seconds before tokens are rejected')
+    args = parser.parse_args()
+
+    simulator = MyQSimulator(doors=args.doors, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate, token_ttl=args.token_ttl)
+    web.run_app(simulator.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
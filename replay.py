@@ -0,0 +1,131 @@
+"""Replay a stream of Alexa events through GarageRequestHandler, to reproduce production traffic or compare builds.
+
+Reads one JSON event per line from a file or stdin, answers up to --concurrency events at a time on one event loop
+(sharing the MyQ login like a warm Lambda container or server.py), and writes one JSON line per event:
+its line number, response, latency and handler phase timings. Events are read as they are needed,
+so the input can be any size.
+
+    python replay.py events.jsonl --concurrency 8 --output results.jsonl
+    python replay.py - --simulate --latency 0.1 < events.jsonl
+
+With --simulate, MyQ is replaced by myq_simulator.py; otherwise USER_NAME and PASSWORD log in to MyQ.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+from typing import List, TextIO
+
+import lambda_function
+from benchmark import event_name, summarize
+from lambda_function import GarageRequestHandler
+from myq_simulator import MyQSimulator, patch_pymyq
+
+
+async def process_line(number: int, line: str) -> dict:
+    """Answer the event on one line and return its result record"""
+    try:
+        event = json.loads(line)
+        name = event_name(event)
+    except (ValueError, KeyError, TypeError) as e:
+        return {'line': number, 'error': f'Not an Alexa event: {e}'}
+    handler = GarageRequestHandler()
+    start = time.perf_counter()
+    response = await handler.process(event)
+    return {
+        'line': number,
+        'intent': name,
+        'ms': round((time.perf_counter() - start) * 1000, 2),
+        'phases': {phase: round(ms, 2) for phase, ms in handler.metrics.timings.items()},
+        'properties': handler.metrics.properties,
+        'response': response,
+    }
+
+
+async def replay(stream: TextIO, output: TextIO, concurrency: int = 8) -> List[float]:
+    """Answer each event in stream, writing results to output as they finish. Return the latencies in ms."""
+    loop = asyncio.get_running_loop()
+    pending = set()
+    latencies = []
+
+    def write(tasks) -> None:
+        for task in tasks:
+            result = task.result()
+            if 'ms' in result:
+                latencies.append(result['ms'])
+            output.write(json.dumps(result) + '\n')
+
+    number = 0
+    while True:
+        # read in a thread, so events in flight keep going while waiting for input
+        line = await loop.run_in_executor(None, stream.readline)
+        if not line:
+            break
+        number += 1
+        if not line.strip():
+            continue
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            write(done)
+        pending.add(asyncio.ensure_future(process_line(number, line)))
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        write(done)
+    output.flush()
+    return latencies
+
+
+def run(stream: TextIO, output: TextIO, concurrency: int = 8) -> List[float]:
+    """Replay on the handler's event loop with metrics collected (for the phase timings) but not printed"""
+    writer, metrics = lambda_function.metrics_writer, os.environ.get('METRICS')
+    lambda_function.metrics_writer = lambda line: None
+    os.environ['METRICS'] = 'Y'
+    try:
+        return lambda_function.get_event_loop().run_until_complete(replay(stream, output, concurrency))
+    finally:
+        lambda_function.metrics_writer = writer
+        if metrics is None:
+            del os.environ['METRICS']
+        else:
+            os.environ['METRICS'] = metrics
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay JSONL Alexa events through the skill')
+    parser.add_argument('events', help='JSONL file of events, or - for stdin')
+    parser.add_argument('--output', help='JSONL file of results (default: stdout)')
+    parser.add_argument('--concurrency', type=int, default=8, help='events answered at a time')
+    parser.add_argument('--simulate', action='store_true', help='answer from a simulated MyQ cloud')
+    parser.add_argument('--doors', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every simulated response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of simulated requests that fail')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.simulate:
+            for name, value in (('USER_NAME', 'replay@example.com'), ('PASSWORD', 'replay'),
+                                ('MYQ_USER_AGENT', 'replay')):
+                os.environ.setdefault(name, value)
+            simulator = MyQSimulator(doors=args.doors, latency=args.latency, error_rate=args.error_rate, seed=0)
+            base_url = simulator.start()
+            stack.callback(simulator.stop)
+            stack.enter_context(patch_pymyq(base_url))
+        stream = sys.stdin if args.events == '-' else stack.enter_context(open(args.events))
+        output = stack.enter_context(open(args.output, 'w')) if args.output else sys.stdout
+        try:
+            latencies = run(stream, output, args.concurrency)
+        finally:
+            lambda_function.get_event_loop().run_until_complete(lambda_function.reset_caches())
+
+    if latencies:
+        print(f'{"n":>4} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}\n{summarize(latencies)}', file=sys.stderr)
+    else:
+        print('No events replayed', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
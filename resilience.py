@@ -0,0 +1,249 @@
+"""How the skill copes with a slow or failing MyQ: concurrent callers share one call (SingleFlight),
+calls stop for a while when MyQ keeps failing (CircuitBreaker), and reads are retried and hedged (RetryPolicy).
+
+aiohttp and pymyq are imported only to classify errors, so importing this module doesn't import them.
+"""
+
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+from config import env
+
+logger = logging.getLogger()
+
+
+class Flight:
+    """A call shared by SingleFlight, and how many callers are waiting for it"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call instead of each making their own.
+
+    Keys name the operation and the account, like ('refresh', user_name), so different operations are never merged.
+    The shared call is cancelled only when every caller waiting for it has given up.
+    """
+
+    flights: Dict[Hashable, Flight]
+
+    def __init__(self):
+        self.flights = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Any:
+        """Await func() or, if a call with the same key is in flight, its result"""
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(asyncio.ensure_future(func()))
+            flight.task.add_done_callback(lambda _: self.done(key, flight))
+        else:
+            logger.debug(f'Joining in-flight {key[0] if isinstance(key, tuple) else key}')
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # the caller timed out or was cancelled; stop the call unless others are waiting for it
+            if flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def done(self, key: Hashable, flight: Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+
+class CircuitOpenError(Exception):
+    """MyQ isn't being called because it kept failing"""
+
+
+class CircuitBreaker:
+    """Stops calling MyQ for a while when it keeps failing or responding slowly, so requests are answered quickly
+    instead of each waiting out its timeout.
+
+    closed: calls go through. BREAKER_FAILURES (default 3, 0 to disable) failures in a row, counting calls
+        slower than BREAKER_SLOW seconds (default 3, not counting the time spent logging in), open the breaker.
+    open: calls fail at once with CircuitOpenError. BREAKER_COOLDOWN seconds (default 30) after opening,
+        the next call goes through as a probe, within its own request's budget.
+    half-open: the probe is running (other calls still fail at once). If it succeeds the breaker closes,
+        otherwise it opens again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    state: str
+    failures: int
+    # time.monotonic() when the breaker last opened
+    opened: float
+
+    def __init__(self, name: str = 'MyQ'):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+
+    @staticmethod
+    def is_failure(e: BaseException) -> bool:
+        """Return True if the error means MyQ is struggling (rather than, say, a wrong password)"""
+        from aiohttp import ClientError
+        from pymyq.errors import RequestError
+        return isinstance(e, (asyncio.TimeoutError, ClientError, RequestError))
+
+    def transition(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f'{self.name} circuit breaker {self.state} -> {state}')
+            self.state = state
+
+    def allow(self) -> bool:
+        """Return True if a call can go through. If the breaker is open and has cooled down, the call is the probe,
+        and its result (passed to record) closes or opens the breaker."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened >= env.float('BREAKER_COOLDOWN', 30):
+            self.transition(self.HALF_OPEN)
+            return True
+        return False
+
+    def trip(self) -> None:
+        self.opened = time.monotonic()
+        self.transition(self.OPEN)
+
+    def record(self, seconds: float, error: Optional[BaseException] = None) -> None:
+        """Count a call that took seconds and raised error (if any)"""
+        if self.state == self.HALF_OPEN:
+            if error is not None:
+                logger.warning(f'{self.name} is still failing: {error!r}')
+                self.trip()
+            elif seconds > env.float('BREAKER_SLOW', 3):
+                logger.warning(f'{self.name} is still slow')
+                self.trip()
+            else:
+                self.failures = 0
+                self.transition(self.CLOSED)
+            return
+        if self.state != self.CLOSED or (error is not None and not self.is_failure(error)):
+            return
+        if error is None and seconds <= env.float('BREAKER_SLOW', 3):
+            self.failures = 0
+            return
+        self.failures += 1
+        threshold = env.int('BREAKER_FAILURES', 3)
+        if threshold and self.failures >= threshold:
+            self.trip()
+
+
+# Set for requests answering a question about the doors, whose reads from MyQ may be hedged (see RetryPolicy)
+hedge_reads: contextvars.ContextVar = contextvars.ContextVar('hedge_reads', default=False)
+
+
+class RetryPolicy:
+    """How requests to MyQ are retried and hedged, in place of pymyq's five tries with fixed delays.
+
+    Reads (the login and device fetches) that fail with a transient error (a connection error, a timeout,
+    or a 408, 429 or 5xx response) are tried up to RETRY_ATTEMPTS times in all (default 3). Before each retry,
+    it waits a random time of up to RETRY_BASE_DELAY seconds (default 0.2), doubling with each retry up to
+    RETRY_MAX_DELAY (default 1), unless that would end more than RETRY_TIME_LIMIT seconds (default 2)
+    after the first try.
+    With HEDGE_READS, a device fetch for a question about the doors (see hedge_reads) that takes longer than
+    the 95th percentile of recent fetches (at least HEDGE_MIN_DELAY seconds, default 0.1) is sent again,
+    and the first response is used.
+    Commands are sent once: MyQ may have moved the door even if the response was lost.
+    """
+
+    TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+    # fetches needed before the 95th percentile is trusted for hedging
+    HEDGE_MIN_SAMPLES = 20
+
+    # seconds taken by recent successful fetches
+    latencies: Deque[float]
+
+    def __init__(self):
+        self.latencies = deque(maxlen=200)
+        self.random = random.Random()
+
+    def is_transient(self, e: BaseException) -> bool:
+        """Return True for errors that trying again might not get"""
+        from aiohttp import ClientError, ClientResponseError
+
+        if isinstance(e, ClientResponseError):
+            return e.status in self.TRANSIENT_STATUSES
+        return isinstance(e, (ClientError, asyncio.TimeoutError))
+
+    def delay(self, retry: int) -> float:
+        """Return the seconds to wait before the retry (from 1), with full jitter"""
+        return self.random.uniform(0, min(env.float('RETRY_MAX_DELAY', 1),
+                                          env.float('RETRY_BASE_DELAY', 0.2) * 2 ** (retry - 1)))
+
+    def hedge_delay(self) -> Optional[float]:
+        """Return the seconds after which a fetch is sent again, or None if it isn't"""
+        if not (hedge_reads.get() and env.bool('HEDGE_READS', False)) or len(self.latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return max(latencies[int(len(latencies) * 0.95)], env.float('HEDGE_MIN_DELAY', 0.1))
+
+    async def call(self, send: Callable[[], Awaitable], idempotent: bool = True, hedge: bool = False) -> Any:
+        """Return the result of send(), retrying it (if idempotent) and hedging it (if hedge) as set up"""
+        if not idempotent:
+            return await send()
+        start = time.monotonic()
+        retry = 0
+        while True:
+            try:
+                delay = self.hedge_delay() if hedge else None
+                return await (self.timed(send) if delay is None else self.hedged(send, delay))
+            except Exception as e:
+                retry += 1
+                if retry >= env.int('RETRY_ATTEMPTS', 3) or not self.is_transient(e):
+                    raise
+                wait = self.delay(retry)
+                if time.monotonic() + wait - start > env.float('RETRY_TIME_LIMIT', 2):
+                    raise
+                logger.info(f'Retrying MyQ request in {wait:.2f} s after {e!r}')
+                await asyncio.sleep(wait)
+
+    async def timed(self, send: Callable[[], Awaitable]) -> Any:
+        start = time.monotonic()
+        result = await send()
+        self.latencies.append(time.monotonic() - start)
+        return result
+
+    async def hedged(self, send: Callable[[], Awaitable], delay: float) -> Any:
+        """Send, and send again if there is no response within delay seconds. Return the first response
+        (send returns an aiohttp response), or raise the error of the last to fail."""
+        pending = {asyncio.ensure_future(self.timed(send))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                logger.info(f'Hedging MyQ request slower than {delay:.2f} s')
+                pending.add(asyncio.ensure_future(self.timed(send)))
+            winner = error = None
+            while True:
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        # both responded at once: free the other's connection
+                        task.result().release()
+                if winner is not None:
+                    return winner.result()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+retry_policy = RetryPolicy()
@@ -2,19 +2,18 @@
 
 # Create zip file with lambda code and deploy
 # (requires AWS credentials in environment or ~/.aws/credentials)
+# Set PYTHON to an interpreter of the Lambda runtime's version with the requirements installed.
 
 set -e
 
 SCRIPT_DIR=$(realpath $(dirname "${BASH_SOURCE[0]}"))
 PROJECT_DIR=$(realpath $SCRIPT_DIR/..)
+PYTHON=${PYTHON:-python}
 FUNCTION=OperateGarage
 ZIP=$FUNCTION.zip
 
 cd $PROJECT_DIR
-echo "Create site-packages.zip ..."
-$SCRIPT_DIR/shrink-site-packages.sh
-
-# keep site packages if we want to reuse it
-cp site-packages.zip $ZIP
-
-$SCRIPT_DIR/update-lambda.sh
+echo "Building $ZIP ..."
+$PYTHON build_lambda.py --python $PYTHON --output $ZIP
+echo "Update lambda function code ..."
+aws lambda update-function-code --region us-east-1 --function-name $FUNCTION --zip-file fileb://$ZIP
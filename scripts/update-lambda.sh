@@ -8,7 +8,7 @@ set -e
 PROJECT_DIR=$(realpath $(dirname "${BASH_SOURCE[0]}")/..)
 FUNCTION=OperateGarage
 ZIP=$PROJECT_DIR/$FUNCTION.zip
-FILES=".env lambda_function.py"
+FILES=".env lambda_function.py background.py config.py myq_api.py resilience.py slot_table.py stores.py"
 
 cd $PROJECT_DIR
 echo "Adding files to $ZIP ..."
@@ -0,0 +1,172 @@
+"""Serve the skill over HTTP(S) for many MyQ accounts from one process, instead of from Lambda.
+
+Each account (household) has its own endpoint, POST /alexa/{account}, and its own settings in the accounts file,
+a JSON object of account names and the settings that would otherwise come from the environment:
+
+    {
+        "smith": {"USER_NAME": "smith@example.com", "PASSWORD": "...", "LEFT": 1},
+        "jones": {"USER_NAME": "jones@example.com", "PASSWORD": "...", "ONLY_CLOSE": false}
+    }
+
+Settings an account doesn't have come from the environment (or .env).
+Every account needs SKILL_ID, and only accepts requests from that skill.
+Requests are answered concurrently on one event loop, sharing warm MyQ clients (see MyQClientPool)
+and door states between requests. Every WARM_INTERVAL seconds (default 300, 0 to disable), each account's login
+and door states are refreshed in the background (see background.Warmer), and with OPEN_ALERT_MINUTES,
+households are alerted about doors left open (see background.DoorMonitor).
+With COMMAND_QUEUE, doors scheduled to close (and AUTO_CLOSE_AT) are closed by a check every COMMAND_INTERVAL seconds
+(default 30, see background.CommandScheduler).
+
+    python server.py --accounts accounts.json --host 0.0.0.0 --port 8443 --cert cert.pem --key key.pem
+
+Alexa only sends requests to HTTPS endpoints, and expects them to check the requests' signatures.
+Requests that aren't signed by Alexa (see alexa_signature) or were sent more than 150 seconds ago are refused.
+The server listens on 127.0.0.1 unless --host is given.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import ssl
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+import lambda_function
+from alexa_signature import RequestVerifier, VerificationError, check_timestamp
+from background import command_scheduler, warmer
+from config import Settings, env
+from lambda_function import GarageRequestHandler, ResponseTemplates
+from stores import get_command_queue
+
+logger = logging.getLogger(__name__)
+
+# shared by all requests, so common responses are serialized once
+response_templates = ResponseTemplates()
+
+
+def load_accounts(path: Path) -> Dict[str, Dict[str, Any]]:
+    """Read the accounts file, making sure each account has what a handler needs"""
+    accounts = json.loads(path.read_text())
+    for name, settings in accounts.items():
+        if not Settings(settings).str('SKILL_ID', ''):
+            # otherwise any skill (or anyone with a signed request to another skill) could move the doors
+            raise ValueError(f'Account {name} has no SKILL_ID')
+        try:
+            GarageRequestHandler(settings)
+        except Exception as e:
+            raise ValueError(f'Account {name} is not set up correctly: {e}') from e
+    return accounts
+
+
+def application_id(event: dict) -> Optional[str]:
+    """Return the ID of the skill that sent the event"""
+    system = event.get('context', {}).get('System', {})
+    return (system.get('application', {}).get('applicationId')
+            or event.get('session', {}).get('application', {}).get('applicationId'))
+
+
+class SkillServer:
+    """Answers Alexa requests for the accounts in the accounts file"""
+
+    accounts: Dict[str, Dict[str, Any]]
+    verifier: RequestVerifier
+    warm_task: Optional[asyncio.Task]
+    command_task: Optional[asyncio.Task]
+
+    def __init__(self, accounts: Dict[str, Dict[str, Any]], verifier: Optional[RequestVerifier] = None):
+        self.accounts = accounts
+        self.verifier = verifier or RequestVerifier()
+        self.warm_task = None
+        self.command_task = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/alexa/{account}', self.alexa)
+        app.on_startup.append(self.startup)
+        app.on_cleanup.append(self.cleanup)
+        return app
+
+    async def startup(self, _app: web.Application) -> None:
+        if env.float('WARM_INTERVAL', 300) > 0:
+            self.warm_task = asyncio.ensure_future(self.keep_warm())
+        if get_command_queue() is not None:
+            self.command_task = asyncio.ensure_future(self.send_commands())
+
+    async def keep_warm(self) -> None:
+        """Refresh every account's login and door states every WARM_INTERVAL seconds"""
+        accounts = [(Settings(settings).str('USER_NAME'), Settings(settings).str('PASSWORD'))
+                    for settings in self.accounts.values()]
+        while True:
+            try:
+                warmed = await warmer.warm(accounts)
+                logger.debug(f'Refreshed {warmed} of {len(accounts)} accounts')
+            except Exception:
+                logger.exception('Failed to refresh accounts')
+            await asyncio.sleep(env.float('WARM_INTERVAL', 300))
+
+    async def send_commands(self) -> None:
+        """Send the scheduled commands that are due every COMMAND_INTERVAL seconds"""
+        accounts = {Settings(settings).str('USER_NAME'): settings for settings in self.accounts.values()}
+        while True:
+            try:
+                sent = await command_scheduler.run(accounts)
+                logger.debug(f'Sent {sent} scheduled commands')
+            except Exception:
+                logger.exception('Failed to send scheduled commands')
+            await asyncio.sleep(env.float('COMMAND_INTERVAL', 30))
+
+    async def alexa(self, request: web.Request) -> web.Response:
+        settings = self.accounts.get(request.match_info['account'])
+        if settings is None:
+            raise web.HTTPNotFound()
+        body = await request.read()
+        try:
+            await self.verifier.verify(request.headers, body)
+            event = json.loads(body)
+            check_timestamp(event)
+        except VerificationError as e:
+            logger.warning(f'Refused request: {e}')
+            raise web.HTTPBadRequest(text='Request is not from Alexa') from None
+        except ValueError:
+            raise web.HTTPBadRequest(text='Expected an Alexa request') from None
+        if application_id(event) != Settings(settings).str('SKILL_ID'):
+            raise web.HTTPForbidden()
+
+        logger.debug(f'Event: {event}')
+        handler = GarageRequestHandler(settings)
+        body = await handler.process(event, render=response_templates.render)
+        return web.Response(body=body, content_type='application/json')
+
+    async def cleanup(self, _app: web.Application) -> None:
+        for task in (self.warm_task, self.command_task):
+            if task is not None:
+                task.cancel()
+        await self.verifier.close()
+        await lambda_function.reset_caches()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve the skill for the MyQ accounts in an accounts file')
+    parser.add_argument('--accounts', type=Path, default=Path('accounts.json'), help='accounts file')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (0.0.0.0 for every interface)')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cert', help='certificate file, to serve HTTPS')
+    parser.add_argument('--key', help='private key file of the certificate')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    ssl_context = None
+    if args.cert:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.cert, args.key)
+
+    logger.info(f'Alexa-PyMyQ {lambda_function.VERSION}')
+    server = SkillServer(load_accounts(args.accounts))
+    web.run_app(server.make_app(), host=args.host, port=args.port, ssl_context=ssl_context)
+
+
+if __name__ == '__main__':
+    main()
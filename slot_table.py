@@ -0,0 +1,52 @@
+"""Slot values and synonyms of interaction_model.json. Generated by build_slot_table.py, don't edit."""
+
+
+def normalize(value: str) -> str:
+    """Return what the user said in the form of the SLOT_VALUES keys"""
+    return ' '.join(value.lower().split())
+
+
+# intent -> slot -> slot type
+INTENT_SLOTS = {
+    'StateIntent': {'Name': 'DoorName', 'State': 'DoorState'},
+    'AllStatesIntent': {'State': 'DoorState'},
+    'MoveIntent': {'Name': 'DoorName', 'Command': 'DoorCommand'},
+    'ScheduleCloseIntent': {'Name': 'DoorName', 'Minutes': 'AMAZON.NUMBER'},
+}
+
+# slot type -> normalized value or synonym -> value ID
+SLOT_VALUES = {
+    'DoorName': {
+        '1': '1',
+        'door': '1',
+        'door 1': '1',
+        '2': '2',
+        'door 2': '2',
+        'left': 'left',
+        'left door': 'left',
+        'the left door': 'left',
+        'right': 'right',
+        'right door': 'right',
+        'the right door': 'right',
+        'both': 'both',
+        'both doors': 'both',
+        'all': 'both',
+        'all doors': 'both',
+    },
+    'DoorState': {
+        'open': 'open',
+        'up': 'open',
+        'closed': 'closed',
+        'shut': 'closed',
+        'down': 'closed',
+        'opening': 'opening',
+        'closing': 'closing',
+    },
+    'DoorCommand': {
+        'open': 'open',
+        'raise': 'open',
+        'close': 'close',
+        'shut': 'close',
+        'lower': 'close',
+    },
+}
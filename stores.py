@@ -0,0 +1,209 @@
+"""Where the skill keeps what must outlive a Lambda container or server process: saved MyQ logins (TokenStore)
+and commands to send later (CommandQueue).
+
+Both are set up from the environment on first use, and what they need (cryptography to encrypt logins,
+sqlite3 for the queue) is imported only then, so they add nothing to the cold start of requests that don't use them.
+"""
+
+import base64
+import hashlib
+import importlib.util
+import logging
+import os
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from config import env
+
+logger = logging.getLogger()
+
+
+class TokenStore:
+    """Where MyQ logins (tokens and account and device IDs) are saved, so a cold start can resume one
+    with a token refresh instead of the full login. Logins are encrypted before they are saved.
+
+    To use an external store, subclass TokenStore and set TOKEN_STORE to module:ClassName.
+    """
+
+    def load(self, account: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def save(self, account: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def delete(self, account: str) -> None:
+        raise NotImplementedError
+
+
+class FileTokenStore(TokenStore):
+    """Saves each login to a file readable only by the owner, in TOKEN_STORE_DIR (default /tmp/alexa-pymyq)"""
+
+    directory: Path
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(directory or env.str('TOKEN_STORE_DIR', '/tmp/alexa-pymyq'))
+
+    def path(self, account: str) -> Path:
+        return self.directory / f'{hashlib.sha256(account.encode()).hexdigest()[:32]}.login'
+
+    def load(self, account: str) -> Optional[bytes]:
+        try:
+            return self.path(account).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def save(self, account: str, data: bytes) -> None:
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path = self.path(account)
+        temp_path = path.with_suffix('.tmp')
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def delete(self, account: str) -> None:
+        self.path(account).unlink(missing_ok=True)
+
+
+_token_store: Optional[TokenStore] = None
+_token_store_loaded = False
+
+
+def get_token_store() -> Optional[TokenStore]:
+    """Return the store set by TOKEN_STORE (file or module:ClassName), or None if logins aren't saved"""
+    global _token_store, _token_store_loaded
+    if not _token_store_loaded:
+        _token_store_loaded = True
+        name = env.str('TOKEN_STORE', '')
+        if not name:
+            _token_store = None
+        elif importlib.util.find_spec('cryptography') is None:
+            logger.warning('TOKEN_STORE is set but the cryptography package is missing, so logins are not saved')
+            _token_store = None
+        elif name == 'file':
+            _token_store = FileTokenStore()
+        else:
+            module_name, _, class_name = name.partition(':')
+            _token_store = getattr(importlib.import_module(module_name), class_name)()
+    return _token_store
+
+
+def login_cipher(user_name: str, password: str):
+    """Return the Fernet cipher for saved logins: TOKEN_STORE_KEY (a Fernet key) or one derived from the
+    account's credentials"""
+    from cryptography.fernet import Fernet
+
+    key = env.str('TOKEN_STORE_KEY', '')
+    if not key:
+        derived = hashlib.pbkdf2_hmac('sha256', password.encode(), user_name.encode(), 100_000)
+        key = base64.urlsafe_b64encode(derived).decode()
+    return Fernet(key)
+
+
+class ScheduledCommand(NamedTuple):
+    # idempotency key: a command is added, and sent, only once per key
+    key: str
+    account: str
+    # serial number of the door, or 'all'
+    door: str
+    command: str
+    # time.time() to send it at
+    due: float
+
+
+class CommandQueue:
+    """Commands to send later, in a SQLite database at COMMAND_QUEUE, so they survive restarts.
+
+    Each command has a key, so retrying whatever added it (like a retried Lambda invocation with the same
+    Alexa request ID) doesn't add it again. A command is claimed (in a transaction) before it is sent,
+    so it is sent at most once even if the sender crashes or another process runs the same queue.
+    A claim is a lease of COMMAND_LEASE seconds (default 300): a command still sending after that was claimed
+    by a sender that crashed, so it is marked failed (it may have been sent) rather than left sending forever.
+    """
+
+    path: Path
+    lease: float
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path or env.str('COMMAND_QUEUE'))
+        self.lease = env.float('COMMAND_LEASE', 300)
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # autocommit, with explicit transactions where commands are claimed
+            self._db = sqlite3.connect(str(self.path), isolation_level=None, timeout=5)
+            self._db.execute('CREATE TABLE IF NOT EXISTS commands (key TEXT PRIMARY KEY, account TEXT, door TEXT, '
+                             'command TEXT, due REAL, status TEXT, updated REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS commands_due ON commands (status, due)')
+        return self._db
+
+    def add(self, command: ScheduledCommand) -> bool:
+        """Queue the command, unless one with its key has been queued. Return True if it was added."""
+        cursor = self.db.execute('INSERT OR IGNORE INTO commands VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (*command, 'pending', time.time()))
+        return cursor.rowcount == 1
+
+    def claim_due(self, accounts: List[str], now: Optional[float] = None) -> List[ScheduledCommand]:
+        """Mark the accounts' pending commands that are due as sending and return them.
+        Their commands whose lease has run out are marked failed."""
+        if not accounts:
+            return []
+        now = time.time() if now is None else now
+        placeholders = ', '.join('?' * len(accounts))
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            expired = self.db.execute(f"SELECT key FROM commands WHERE status = 'sending' AND updated < ? "
+                                      f'AND account IN ({placeholders})', (now - self.lease, *accounts)).fetchall()
+            for key, in expired:
+                logger.warning(f'Scheduled command {key} was claimed but not finished, marking it failed')
+            self.db.executemany("UPDATE commands SET status = 'failed', updated = ? WHERE key = ?",
+                                [(now, key) for key, in expired])
+            rows = self.db.execute(f"SELECT key, account, door, command, due FROM commands WHERE status = 'pending' "
+                                   f'AND due <= ? AND account IN ({placeholders}) ORDER BY due', (now, *accounts))
+            commands = [ScheduledCommand(*row) for row in rows.fetchall()]
+            self.db.executemany("UPDATE commands SET status = 'sending', updated = ? WHERE key = ?",
+                                [(now, command.key) for command in commands])
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return commands
+
+    def finish(self, key: str, status: str) -> None:
+        """Record what happened to a claimed command: sent, skipped or failed, or pending to claim it again"""
+        self.db.execute('UPDATE commands SET status = ?, updated = ? WHERE key = ?', (status, time.time(), key))
+
+    def status(self, key: str) -> Optional[str]:
+        row = self.db.execute('SELECT status FROM commands WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+_command_queue: Optional[CommandQueue] = None
+_command_queue_loaded = False
+
+
+def get_command_queue() -> Optional[CommandQueue]:
+    """Return the queue at COMMAND_QUEUE, or None if commands can't be scheduled"""
+    global _command_queue, _command_queue_loaded
+    if not _command_queue_loaded:
+        _command_queue_loaded = True
+        _command_queue = CommandQueue() if env.str('COMMAND_QUEUE', '') else None
+    return _command_queue
+
+
+def reset() -> None:
+    """Set up the stores from the environment again on next use"""
+    global _token_store_loaded, _command_queue_loaded
+    _token_store_loaded = False
+    if _command_queue is not None:
+        _command_queue.close()
+    _command_queue_loaded = False
@@ -1,12 +1,32 @@
+import asyncio
+import io
 import json
 import os
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from pymyq.errors import AuthenticationError, RequestError
 
+import background
+import benchmark
+import build_lambda
+import build_slot_table
+import import_profile
+import lambda_function
+import replay
+import resilience
+import server
+import stores
+from conftest import AlexaSigner, FakeContext, FakeMyQ, signed_event
 from lambda_function import lambda_handler
+from myq_simulator import SimulatedDoor
 
 # Tests assume there are two doors and both are closed
+# (tests using fake_login or simulator don't contact MyQ)
 
 # Set MOCK_MYQ_COMMANDS to False in order to test open/close commands
 # Even when true, tests will still authenticate and get current state
@@ -49,12 +69,6 @@ open_door_action = slot_value('DoorCommand', 'open')
 close_door_action = slot_value('DoorCommand', 'shut', 'close')
 
 
-@pytest.fixture()
-def event():
-    with Path('event.json').open() as f:
-        return json.load(f)
-
-
 def test_launch(event):
     event['request']['type'] = 'LaunchRequest'
     result = lambda_handler(event)
@@ -145,3 +159,808 @@ def test_stop(event):
     event['request']['intent'] = {'name': 'AMAZON.StopIntent'}
     result = lambda_handler(event)
     assert result['response']['outputSpeech']['text'] == 'Goodbye'
+
+
+def test_warm_client_reused(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert fake_login.call_count == 1
+    # after the login and again for the warm request
+    assert lambda_function.myq_clients.clients['user'].myq.update_devices.await_count == 2
+
+
+def test_metrics(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'METRICS': 'Y'})
+    writer = mocker.patch.object(lambda_function, 'metrics_writer')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    lambda_handler(event)
+    cold, warm = (json.loads(call.args[0]) for call in writer.call_args_list)
+    assert cold['Intent'] == 'AllStatesIntent'
+    assert (cold['StateCache'], cold['Login'], cold['DoorCount']) == ('miss', 'cold', 2)
+    assert warm['StateCache'] == 'hit'
+    assert {'login', 'devices', 'intent', 'response', 'total'} <= set(cold)
+    assert cold['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Intent']]
+
+
+def test_state_answered_from_cache(event, fake_login):
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    lambda_handler(event)
+    # only after the login
+    lambda_function.myq_clients.clients['user'].myq.update_devices.assert_awaited_once()
+
+
+def test_move_updates_cached_state(event, fake_login, mocker):
+    mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, return_value=mocker.MagicMock())
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    lambda_function.myq_clients.clients['user'].myq.devices['serial0'].device_json['state']['door_state'] = 'open'
+    lambda_function.state_cache.invalidate('user')
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {'Name': left_door_name, 'Command': close_door_action}}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Ok, closing the left door now'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == 'The left door is closing, and the right door is closed.'
+
+
+def test_warm_client_refreshes_token(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    myq = lambda_function.myq_clients.clients['user'].myq
+    myq._security_token = (myq._security_token[0], datetime.utcnow() + timedelta(seconds=30), None)
+    lambda_handler(event)
+    myq.authenticate.assert_awaited_once()
+    assert fake_login.call_count == 1
+
+
+def test_warm_client_rebuilt_after_401(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    lambda_function.myq_clients.clients['user'].myq.update_devices.side_effect = AuthenticationError('401')
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert fake_login.call_count == 2
+
+
+def test_breaker_answers_from_old_states_while_myq_fails(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0', 'BREAKER_FAILURES': '2', 'BREAKER_COOLDOWN': '60'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    myq = lambda_function.myq_clients.clients['user'].myq
+    myq.update_devices.side_effect = RequestError('500')
+    for _ in range(2):
+        assert lambda_handler(event)['response']['card']['title'] == 'MyQ - Try again'
+
+    myq.update_devices.reset_mock()
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == 'Both doors are closed as of a moment ago'
+    myq.update_devices.assert_not_awaited()
+
+    event['request']['intent'] = {'name': 'MoveIntent', 'slots': {'Name': left_door_name, 'Command': close_door_action}}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == \
+        "Sorry. MyQ isn't responding right now. Please try again in a few minutes"
+
+
+def test_breaker_closes_after_probe(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0', 'BREAKER_FAILURES': '1', 'BREAKER_COOLDOWN': '0'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    client = lambda_function.myq_clients.clients['user']
+    client.myq.update_devices.side_effect = RequestError('500')
+    lambda_handler(event)
+    assert client.breaker.state == 'open'
+
+    # after the cooldown, the next request probes MyQ itself, within its own budget
+    assert lambda_handler(event)['response']['card']['title'] == 'MyQ - Try again'
+    assert client.breaker.state == 'open'
+    client.myq.update_devices.side_effect = None
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert client.breaker.state == 'closed'
+
+
+def test_breaker_not_opened_by_slow_logins(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0', 'BREAKER_FAILURES': '1', 'BREAKER_SLOW': '0.1',
+                                   'BREAKER_COOLDOWN': '0'})
+
+    async def login(*args, **kwargs):
+        await asyncio.sleep(0.2)
+        return FakeMyQ('closed', 'closed')
+
+    fake_login.side_effect = login
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    client = lambda_function.myq_clients.clients['user']
+    assert client.breaker.state == 'closed'
+
+    # a probe that has to log in again closes the breaker too
+    client.breaker.trip()
+    client.myq.update_devices.side_effect = AuthenticationError('401')
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert fake_login.call_count == 2
+    assert client.breaker.state == 'closed'
+
+
+def test_scheduled_event_warms_login(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'WARM_JITTER': '0'})
+    mocker.patch.object(background, 'warmer', background.Warmer())
+    assert lambda_handler({'detail-type': 'Scheduled Event', 'source': 'aws.events'}) == {'warmed': 1}
+    assert fake_login.call_count == 1
+    # rate limited
+    assert lambda_handler({'warm': True}) == {'warmed': 0}
+
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert fake_login.call_count == 1
+    # only by the scheduled event
+    lambda_function.myq_clients.clients['user'].myq.update_devices.assert_awaited_once()
+
+
+def test_scheduled_event_retries_failed_warm(fake_login, mocker):
+    mocker.patch.object(background, 'warmer', background.Warmer())
+    fake_login.side_effect = RequestError('500')
+    start = time.monotonic()
+    assert lambda_handler({'warm': True}, FakeContext(5000)) == {'warmed': 0}
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('closed', 'closed')
+    assert lambda_handler({'warm': True}, FakeContext(5000)) == {'warmed': 1}
+    # no jitter with one account
+    assert time.monotonic() - start < 1
+
+
+def test_warm_jitter_leaves_time_to_log_in(fake_login, mocker):
+    mocker.patch.dict(os.environ, {'WARM_JITTER': '5'})
+    accounts = [('user', 'password'), ('user2', 'password')]
+    start = time.monotonic()
+    warmed = lambda_function.get_event_loop().run_until_complete(
+        background.Warmer().warm(accounts, FakeContext(3000)))
+    assert warmed == 2
+    assert time.monotonic() - start < 1
+
+
+def test_scheduled_event_alerts_door_left_open(fake_login, mocker):
+    mocker.patch.dict(os.environ, {'WARM_JITTER': '0', 'WARM_MIN_INTERVAL': '0', 'OPEN_ALERT_MINUTES': '0.001',
+                                   'NOTIFIER': 'log'})
+    mocker.patch.object(background, 'warmer', background.Warmer())
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'closed', 'open')
+    scheduled_event = {'detail-type': 'Scheduled Event', 'source': 'aws.events'}
+    lambda_handler(scheduled_event)
+    notifier = background.get_notifier()
+    assert notifier.sent == []
+
+    time.sleep(0.1)
+    lambda_handler(scheduled_event)
+    [(account, alerts)] = notifier.sent
+    assert account == 'user'
+    assert [alert.name for alert in alerts] == ['Door 0', 'Door 2']
+    assert notifier.message(alerts) == 'Door 0 has been open for a moment and Door 2 has been open for a moment'
+    # alerted once until the door is opened again
+    lambda_handler(scheduled_event)
+    assert len(notifier.sent) == 1
+
+
+def test_door_monitor_checks_only_changed_doors(mocker):
+    mocker.patch.dict(os.environ, {'OPEN_ALERT_MINUTES': '10', 'NOTIFIER': 'log'})
+    monitor = background.DoorMonitor()
+    door = lambda_function.CachedDoor
+    assert monitor.observe('a', [door('a1', 'Left', 'open'), door('a2', 'Right', 'closed')], now=0) == 2
+    assert monitor.observe('b', [door('b1', 'Shed', 'open')], now=60) == 1
+    assert monitor.observe('a', [door('a1', 'Left', 'open'), door('a2', 'Right', 'closed')], now=120) == 0
+    # closed and opened again before its deadline, so the first deadline is stale
+    monitor.observe('b', [door('b1', 'Shed', 'closed')], now=120)
+    monitor.observe('b', [door('b1', 'Shed', 'open')], now=180)
+    assert monitor.due(now=599) == {}
+    assert monitor.due(now=700) == {'a': [background.DoorAlert('a', 'a1', 'Left', 700)]}
+    assert lambda_function.get_event_loop().run_until_complete(monitor.check(now=800)) == 1
+    assert background.get_notifier().sent == [('b', [background.DoorAlert('b', 'b1', 'Shed', 620)])]
+    assert monitor.deadlines == []
+
+
+def test_close_all_concurrent_partial_failure(event, fake_login, mocker):
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'closed', 'open')
+
+    async def close(door, wait_for_state=False):
+        if door.device_id == 'serial2':
+            raise RuntimeError('opener offline')
+        return mocker.MagicMock()
+
+    mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, side_effect=close)
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {
+                                      'Name': both_door_name,
+                                      'Command': close_door_action
+                                  }}
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == \
+        "Ok, closing the left garage door now, but I couldn't close garage door 3"
+
+
+def test_scheduled_close_sent_once(event, fake_login, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'COMMAND_QUEUE': str(tmp_path / 'commands.db')})
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'open')
+    close = mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, return_value=mocker.MagicMock())
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'ScheduleCloseIntent',
+                                  'slots': {'Name': left_door_name, 'Minutes': {'name': 'Minutes', 'value': '10'}}}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == "Ok, I'll close the left door in 10 minutes"
+    # a retried request isn't scheduled again
+    lambda_handler(event)
+
+    loop = lambda_function.get_event_loop()
+    scheduler = background.command_scheduler
+    assert loop.run_until_complete(scheduler.run({'user': None})) == 0
+    later = time.time() + 601
+    assert loop.run_until_complete(scheduler.run({'user': None}, now=later)) == 1
+    assert [call.args[0].device_id for call in close.call_args_list] == ['serial0']
+    assert stores.get_command_queue().status('request:amzn1.echo-api.request.1') == 'sent'
+    assert loop.run_until_complete(scheduler.run({'user': None}, now=later)) == 0
+    assert close.call_count == 1
+
+
+def test_scheduled_close_without_request_id_sent_once(event, fake_login, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'COMMAND_QUEUE': str(tmp_path / 'commands.db')})
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'open')
+    close = mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, return_value=mocker.MagicMock())
+    event['request']['type'] = 'IntentRequest'
+    del event['request']['requestId']
+    event['session']['new'] = False
+    event['request']['intent'] = {'name': 'ScheduleCloseIntent',
+                                  'slots': {'Name': left_door_name, 'Minutes': {'name': 'Minutes', 'value': '10'}}}
+    lambda_handler(event)
+    lambda_handler(event)
+    loop = lambda_function.get_event_loop()
+    assert loop.run_until_complete(background.command_scheduler.run({'user': None}, now=time.time() + 661)) == 1
+    assert close.call_count == 1
+
+
+def test_scheduled_close_retried_after_failed_login(event, fake_login, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'COMMAND_QUEUE': str(tmp_path / 'commands.db')})
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'open')
+    close = mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, return_value=mocker.MagicMock())
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'ScheduleCloseIntent',
+                                  'slots': {'Name': left_door_name, 'Minutes': {'name': 'Minutes', 'value': '10'}}}
+    lambda_handler(event)
+    loop = lambda_function.get_event_loop()
+    loop.run_until_complete(lambda_function.reset_caches())
+
+    fake_login.side_effect = RequestError('500')
+    scheduler = background.command_scheduler
+    later = time.time() + 601
+    assert loop.run_until_complete(scheduler.run({'user': None}, now=later, context=FakeContext(5000))) == 0
+    # nothing was sent, so it is tried again
+    assert stores.get_command_queue().status('request:amzn1.echo-api.request.1') == 'pending'
+    loop.run_until_complete(lambda_function.reset_caches())
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'open')
+    assert loop.run_until_complete(scheduler.run({'user': None}, now=later + 60)) == 1
+    assert close.call_count == 1
+
+
+def test_scheduled_close_given_up_after_retry_window(event, fake_login, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'COMMAND_QUEUE': str(tmp_path / 'commands.db'), 'COMMAND_RETRY_WINDOW': '60'})
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'open')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'ScheduleCloseIntent',
+                                  'slots': {'Name': left_door_name, 'Minutes': {'name': 'Minutes', 'value': '10'}}}
+    lambda_handler(event)
+    loop = lambda_function.get_event_loop()
+    loop.run_until_complete(lambda_function.reset_caches())
+
+    fake_login.side_effect = RequestError('500')
+    assert loop.run_until_complete(background.command_scheduler.run({'user': None}, now=time.time() + 661)) == 0
+    assert stores.get_command_queue().status('request:amzn1.echo-api.request.1') == 'failed'
+
+
+def test_scheduled_event_warms_after_command_error(fake_login, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'COMMAND_QUEUE': str(tmp_path / 'commands.db'), 'WARM_JITTER': '0'})
+    mocker.patch.object(background, 'warmer', background.Warmer())
+    mocker.patch.object(background.command_scheduler, 'run', side_effect=RuntimeError('database is locked'))
+    assert lambda_handler({'detail-type': 'Scheduled Event', 'source': 'aws.events'}) == {'warmed': 1}
+    assert fake_login.call_count == 1
+
+
+def test_command_queue_fails_expired_claims(tmp_path):
+    queue = stores.CommandQueue(str(tmp_path / 'commands.db'))
+    command = stores.ScheduledCommand('key', 'user', 'all', 'close', 100.0)
+    assert queue.add(command)
+    assert queue.claim_due(['user'], now=200) == [command]
+    # the sender crashed without finishing the command
+    assert queue.claim_due(['user'], now=210) == []
+    assert queue.status('key') == 'sending'
+    assert queue.claim_due(['user'], now=200 + queue.lease + 1) == []
+    assert queue.status('key') == 'failed'
+    queue.close()
+
+
+def test_auto_close_skips_closed_doors(fake_login, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'COMMAND_QUEUE': str(tmp_path / 'commands.db'), 'AUTO_CLOSE_AT': '22:00',
+                                   'UTC_OFFSET': '0'})
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('closed', 'open', 'closing')
+    close = mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, return_value=mocker.MagicMock())
+    loop = lambda_function.get_event_loop()
+    scheduler = background.command_scheduler
+    evening = datetime(2021, 6, 1, 21, 59, tzinfo=timezone.utc).timestamp()
+    assert background.next_auto_close('22:00', evening, 0) == datetime(2021, 6, 1, 22, 0, tzinfo=timezone.utc)
+    assert loop.run_until_complete(scheduler.run({'user': None}, now=evening)) == 0
+    assert loop.run_until_complete(scheduler.run({'user': None}, now=evening + 120)) == 1
+    assert [call.args[0].device_id for call in close.call_args_list] == ['serial1']
+    # the next one is queued for the next day
+    assert stores.get_command_queue().status('auto-close:user:2021-06-01') == 'sent'
+    assert stores.get_command_queue().status('auto-close:user:2021-06-02') == 'pending'
+
+
+def test_door_positions_stable_when_myq_reorders(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0', 'RIGHT': 'serial0', 'LEFT': 'Door 1'})
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'closed')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == \
+        'The left door is closed, and the right door is open.'
+
+    myq = lambda_function.myq_clients.clients['user'].myq
+    myq.devices = dict(reversed(list(myq.devices.items())))
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == \
+        'The left door is closed, and the right door is open.'
+    assert myq.device_order == ['serial0', 'serial1']
+
+
+def test_doors_numbered_in_myq_order_on_cold_start(event, fake_login):
+    def login(*args, **kwargs):
+        myq = FakeMyQ('open', 'closed')
+        myq.devices = dict(reversed(list(myq.devices.items())))
+        return myq
+
+    fake_login.side_effect = login
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == \
+        'The left door is closed, and the right door is open.'
+    assert lambda_function.myq_clients.clients['user'].myq.device_order == ['serial1', 'serial0']
+
+
+def test_door_found_by_myq_name(event, fake_login):
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'closed')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'StateIntent',
+                                  'slots': {
+                                      'Name': {'name': 'Name', 'value': 'door 0',
+                                               'resolutions': {'resolutionsPerAuthority': [{}]}},
+                                      'State': {'name': 'State', 'value': ''}
+                                  }}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'door 0 is open'
+
+
+def test_slot_synonym_without_resolution(event, fake_login):
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'closed')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'StateIntent',
+                                  'slots': {
+                                      'Name': {'name': 'Name', 'value': 'The  Right Door'},
+                                      'State': {'name': 'State', 'value': 'shut'}
+                                  }}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Yes, The  Right Door is shut'
+
+
+def test_slot_table_up_to_date():
+    assert Path('slot_table.py').read_text() == build_slot_table.generate(), 'Run python build_slot_table.py'
+
+
+def test_single_flight_shares_calls_by_key():
+    flights = resilience.SingleFlight()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key
+
+    async def run():
+        return await asyncio.gather(flights.do('refresh', lambda: fetch('refresh')),
+                                    flights.do('refresh', lambda: fetch('refresh')),
+                                    flights.do('login', lambda: fetch('login')))
+
+    assert lambda_function.get_event_loop().run_until_complete(run()) == ['refresh', 'refresh', 'login']
+    assert calls == ['refresh', 'login']
+    assert not flights.flights
+
+
+def test_simulated_close(event, simulator):
+    simulator.doors['CG00000000'].command('open')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {
+                                      'Name': both_door_name,
+                                      'Command': close_door_action
+                                  }}
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == 'Ok, closing the left garage door now'
+    assert simulator.commands == [('CG00000000', 'close')]
+
+
+def test_simulated_close_all_with_slow_myq(event, simulator, mocker):
+    # each command takes longer than half the timeout, so a door waiting for the others' would run out of time
+    mocker.patch.dict(os.environ, {'DOOR_COMMAND_TIMEOUT': '0.5'})
+    simulator.doors['CG00000002'] = SimulatedDoor('CG00000002', 'Garage Door 3', 'open', 0)
+    for door in simulator.doors.values():
+        door.command('open')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    simulator.latency = 0.3
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {'Name': both_door_name, 'Command': close_door_action}}
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == 'Ok, closing all garage doors now'
+    assert sorted(simulator.commands) == [('CG00000000', 'close'), ('CG00000001', 'close'), ('CG00000002', 'close')]
+
+
+def test_simulated_close_confirmed(event, simulator, mocker):
+    mocker.patch.dict(os.environ, {'CONFIRM_COMMANDS': 'Y', 'CONFIRM_TIMEOUT': '1'})
+    simulator.doors['CG00000000'].command('open')
+    simulator.doors['CG00000000'].transition_time = 0.3
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {
+                                      'Name': left_door_name,
+                                      'Command': close_door_action
+                                  }}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'the left door is closed'
+
+    lambda_function.get_event_loop().run_until_complete(lambda_function.reset_caches())
+    simulator.doors['CG00000000'].command('open')
+    simulator.doors['CG00000000'].transition_time = 5
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'the left door is still closing'
+
+
+def test_simulated_warm_request_fetches_doors(event, simulator, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    # well within pymyq's 10 s between device fetches
+    simulator.doors['CG00000000'].command('open')
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'] == 'The left door is open, and the right door is closed.'
+    assert simulator.full_logins == 1
+
+
+def test_simulated_concurrent_requests_share_login(event, simulator):
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+
+    async def run():
+        handlers = [lambda_function.GarageRequestHandler() for _ in range(3)]
+        return await asyncio.gather(*(handler.process(json.loads(json.dumps(event))) for handler in handlers))
+
+    results = lambda_function.get_event_loop().run_until_complete(run())
+    assert [result['response']['outputSpeech']['text'] for result in results] == ['Both doors are closed'] * 3
+    assert simulator.full_logins == 1
+
+
+def test_simulated_transient_failures_retried(event, simulator, mocker):
+    mocker.patch.dict(os.environ, {'RETRY_BASE_DELAY': '0.01'})
+    simulator.failures = 2
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert simulator.failures == 0
+
+
+def test_simulated_command_sent_once(event, simulator):
+    simulator.doors['CG00000000'].command('open')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    simulator.command_failures = 1
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {'Name': left_door_name, 'Command': close_door_action}}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == \
+        'Sorry. There was an error processing your request'
+    assert len(simulator.timings['command']) == 1
+    assert simulator.commands == []
+
+
+def test_retry_policy_hedges_slow_reads(mocker):
+    mocker.patch.dict(os.environ, {'HEDGE_READS': 'Y', 'HEDGE_MIN_DELAY': '0.05'})
+    policy = resilience.RetryPolicy()
+    policy.latencies.extend([0.01] * policy.HEDGE_MIN_SAMPLES)
+    delays = [1, 0]
+
+    async def send():
+        await asyncio.sleep(delays.pop(0))
+        return 'response'
+
+    async def read():
+        resilience.hedge_reads.set(True)
+        start = time.monotonic()
+        assert await policy.call(send, hedge=True) == 'response'
+        return time.monotonic() - start
+
+    assert lambda_function.get_event_loop().run_until_complete(read()) < 0.5
+    assert delays == []
+
+
+def test_server_answers_each_account(event, simulator, mocker):
+    mocker.patch.dict(os.environ, {'MYQ_CLIENTS': '1', 'WARM_INTERVAL': '0'})
+    skill_id = event['session']['application']['applicationId']
+    accounts = {'smith': {'USER_NAME': 'smith', 'PASSWORD': 'password', 'SKILL_ID': skill_id},
+                'jones': {'USER_NAME': 'jones', 'PASSWORD': 'password', 'SKILL_ID': 'other skill'}}
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    signer = AlexaSigner()
+    body = signed_event(event)
+
+    async def run():
+        app = server.SkillServer(accounts, signer.verifier(mocker)).make_app()
+        async with TestClient(TestServer(app)) as client:
+            responses = [await client.post(path, data=body, headers=signer.headers(body))
+                         for path in ('/alexa/smith', '/alexa/jones', '/alexa/x')]
+            return [response.status for response in responses], await responses[0].json()
+
+    statuses, result = lambda_function.get_event_loop().run_until_complete(run())
+    assert statuses == [200, 403, 404]
+    assert result['response']['outputSpeech']['text'] == 'Both doors are closed'
+
+
+def test_server_refuses_requests_not_from_alexa(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'WARM_INTERVAL': '0'})
+    accounts = {'smith': {'USER_NAME': 'smith', 'PASSWORD': 'password',
+                          'SKILL_ID': event['session']['application']['applicationId']}}
+    signer = AlexaSigner()
+    body = signed_event(event)
+    stale_event = json.loads(body)
+    stale_event['request']['timestamp'] = '2016-10-27T18:21:44Z'
+    stale_body = json.dumps(stale_event).encode()
+    # a certificate for another name, from a root the server doesn't trust
+    other = AlexaSigner('example.com')
+
+    async def run():
+        app = server.SkillServer(accounts, signer.verifier(mocker)).make_app()
+        async with TestClient(TestServer(app)) as client:
+            requests = [(body, {}),
+                        (body, signer.headers(b'another body')),
+                        (body, dict(signer.headers(body), SignatureCertChainUrl='https://example.com/echo.api/c.pem')),
+                        (body, other.headers(body)),
+                        (stale_body, signer.headers(stale_body)),
+                        (body, signer.headers(body))]
+            return [(await client.post('/alexa/smith', data=data, headers=headers)).status
+                    for data, headers in requests]
+
+    assert lambda_function.get_event_loop().run_until_complete(run()) == [400, 400, 400, 400, 400, 200]
+    fake_login.assert_called_once()
+
+
+def test_server_keeps_warming_after_errors(mocker):
+    mocker.patch.dict(os.environ, {'WARM_INTERVAL': '0.01'})
+    accounts = {'smith': {'USER_NAME': 'smith', 'PASSWORD': 'password', 'SKILL_ID': 'skill'}}
+    calls = []
+
+    async def warm(accounts, context=None):
+        calls.append(accounts)
+        if len(calls) == 1:
+            # like a NOTIFIER that can't be imported
+            raise ModuleNotFoundError("No module named 'notifiers'")
+        return 1
+
+    mocker.patch.object(background.warmer, 'warm', side_effect=warm)
+
+    async def run():
+        task = asyncio.ensure_future(server.SkillServer(accounts).keep_warm())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        return task.done()
+
+    assert not lambda_function.get_event_loop().run_until_complete(run())
+    assert len(calls) > 1
+
+
+def test_server_needs_skill_id(tmp_path):
+    path = tmp_path / 'accounts.json'
+    path.write_text(json.dumps({'smith': {'USER_NAME': 'smith', 'PASSWORD': 'password'}}))
+    with pytest.raises(ValueError, match='Account smith has no SKILL_ID'):
+        server.load_accounts(path)
+
+
+def test_alexa_certificate_urls():
+    from alexa_signature import VerificationError, check_cert_url
+    for url in ('https://s3.amazonaws.com/echo.api/echo-api-cert.pem',
+                'https://s3.amazonaws.com:443/echo.api/echo-api-cert.pem',
+                'HTTPS://s3.AmazonAWS.com/echo.api/../echo.api/echo-api-cert.pem'):
+        check_cert_url(url)
+    for url in ('http://s3.amazonaws.com/echo.api/echo-api-cert.pem',
+                'https://notamazon.com/echo.api/echo-api-cert.pem',
+                'https://s3.amazonaws.com/EcHo.aPi/echo-api-cert.pem',
+                'https://s3.amazonaws.com/invalid.path/echo-api-cert.pem',
+                'https://s3.amazonaws.com:563/echo.api/echo-api-cert.pem',
+                'https://s3.amazonaws.com/echo.api/../invalid.path/echo-api-cert.pem'):
+        with pytest.raises(VerificationError):
+            check_cert_url(url)
+
+
+def test_client_pool_evicts_least_recently_used(mocker):
+    mocker.patch.dict(os.environ, {'MYQ_CLIENTS': '2'})
+    pool = lambda_function.MyQClientPool()
+
+    async def run():
+        busy = await pool.acquire('a')
+        for user_name in ('b', 'c', 'd'):
+            await pool.release(await pool.acquire(user_name))
+        # 'a' is the least recently used but is still in use, so idle clients were closed instead
+        in_use = list(pool.clients)
+        await pool.release(busy)
+        await pool.release(await pool.acquire('e'))
+        return in_use, list(pool.clients)
+
+    assert lambda_function.get_event_loop().run_until_complete(run()) == (['a', 'd'], ['d', 'e'])
+
+
+def test_simulated_token_expired(event, simulator, mocker):
+    mocker.patch.dict(os.environ, {'STATE_CACHE_TTL': '0'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    simulator.expire_tokens()
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+
+
+def test_saved_login_resumed(event, simulator, mocker, tmp_path):
+    mocker.patch.dict(os.environ, {'TOKEN_STORE': 'file', 'TOKEN_STORE_DIR': str(tmp_path)})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    saved = next(tmp_path.iterdir()).read_bytes()
+    assert b'refresh' not in saved and b'CG00000000' not in saved
+
+    # a new container resumes the saved login with a token refresh
+    lambda_function.get_event_loop().run_until_complete(lambda_function.reset_caches())
+    simulator.expire_tokens()
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert (simulator.full_logins, simulator.token_refreshes) == (1, 1)
+
+    # a rejected refresh token falls back to the full login
+    lambda_function.get_event_loop().run_until_complete(lambda_function.reset_caches())
+    simulator.expire_tokens(refresh_tokens=True)
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Both doors are closed'
+    assert simulator.full_logins == 2
+
+
+def test_response_templates_match_response_dicts():
+    templates = lambda_function.ResponseTemplates()
+    speechlets = [*benchmark.sample_speechlets(), lambda_function.Speechlet('Say "hi"', 'Tür\n\\', 'Ask again'), None]
+    for speechlet in speechlets * 2:
+        expected = lambda_function.GarageRequestHandler.build_response({}, speechlet)
+        assert json.loads(templates.render(speechlet)) == expected
+    assert benchmark.benchmark_responses(iterations=100).keys() == {'dict + json.dumps', 'templates',
+                                                                    'templates, cached'}
+
+
+def test_benchmark(simulator):
+    run = benchmark.Benchmark(simulator)
+    run.run(benchmark.load_events(), iterations=1)
+    assert run.latencies['warm', 'AllStatesIntent']
+    assert 'AllStatesIntent' in run.report()
+
+
+def test_replay(simulator, tmp_path):
+    events = [json.loads(path.read_text()) for path in sorted(Path('events').glob('*.json'))]
+    path = tmp_path / 'events.jsonl'
+    path.write_text(''.join(json.dumps(event) + '\n' for event in events) + 'not an event\n')
+    output = io.StringIO()
+    with path.open() as stream:
+        latencies = replay.run(stream, output, concurrency=2)
+    results = sorted((json.loads(line) for line in output.getvalue().splitlines()), key=lambda result: result['line'])
+    assert len(latencies) == len(events)
+    assert [result['line'] for result in results] == list(range(1, len(events) + 2))
+    assert 'error' in results[-1]
+    assert all(result['response']['response']['outputSpeech']['text'] for result in results[:-1])
+    assert all('total' in result['phases'] for result in results[:-1])
+
+
+def test_slow_command_answers_before_deadline(event, fake_login, mocker):
+    fake_login.side_effect = lambda *args, **kwargs: FakeMyQ('open', 'closed')
+
+    async def close(door, wait_for_state=False):
+        await asyncio.sleep(1)
+        return mocker.MagicMock()
+
+    mocker.patch('pymyq.garagedoor.MyQGaragedoor.close', autospec=True, side_effect=close)
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'MoveIntent',
+                                  'slots': {
+                                      'Name': left_door_name,
+                                      'Command': close_door_action
+                                  }}
+    result = lambda_handler(event, FakeContext(500))
+    assert result['response']['outputSpeech']['text'] == \
+        "Sorry, I couldn't send the command to close the left door, MyQ didn't answer in time"
+    # the command was cancelled rather than left to be sent during a later request
+    assert not [task for task in asyncio.all_tasks(lambda_function.get_event_loop()) if not task.done()]
+
+
+def test_slow_login_answers_before_deadline(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'LOGIN_TIMEOUT': '0.1'})
+
+    async def login(*args, **kwargs):
+        await asyncio.sleep(1)
+
+    fake_login.side_effect = login
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    result = lambda_handler(event, FakeContext(5000))
+    assert result['response']['outputSpeech']['text'].startswith('Sorry. MyQ is taking too long')
+
+
+def test_help_without_myq(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'DOOR_COUNT': '1'})
+    event['request']['type'] = 'LaunchRequest'
+    assert lambda_handler(event)['response']['outputSpeech']['text'].startswith('You can close the door.')
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AMAZON.HelpIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'].startswith('You can close the door.')
+    fake_login.assert_not_called()
+
+
+def test_help_uses_fetched_door_count(event, fake_login, mocker):
+    mocker.patch.dict(os.environ, {'DOOR_COUNT': '1'})
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AllStatesIntent'}
+    lambda_handler(event)
+    event['request']['intent'] = {'name': 'AMAZON.HelpIntent'}
+    result = lambda_handler(event)
+    assert result['response']['outputSpeech']['text'].startswith('You can close the left or right door')
+
+
+def test_stop_without_myq(event, fake_login):
+    event['request']['type'] = 'IntentRequest'
+    event['request']['intent'] = {'name': 'AMAZON.StopIntent'}
+    assert lambda_handler(event)['response']['outputSpeech']['text'] == 'Goodbye'
+    event['request'] = {'type': 'SessionEndedRequest', 'requestId': 'amzn1.echo-api.request.2'}
+    lambda_handler(event)
+    fake_login.assert_not_called()
+
+
+def test_build_lambda(tmp_path):
+    report = build_lambda.build(tmp_path / 'function.zip', layer=tmp_path / 'layer.zip', dotenv=False, runs=1)
+    with zipfile.ZipFile(tmp_path / 'function.zip') as function_zip, zipfile.ZipFile(tmp_path / 'layer.zip') as layer:
+        assert sorted(function_zip.namelist()) == ['background.pyc', 'config.pyc', 'lambda_function.pyc', 'myq_api.pyc',
+                                                   'resilience.pyc', 'slot_table.pyc', 'stores.pyc']
+        names = layer.namelist()
+    assert 'python/pymyq/api.pyc' in names and 'python/environs/__init__.pyc' in names
+    # marshmallow reads its version from its metadata when environs imports it
+    assert [name for name in names if name.startswith('python/marshmallow-') and name.endswith('.dist-info/METADATA')]
+    assert not [name for name in names if name.endswith('.py')]
+    # measured by importing from the zips alone, so everything a request imports is in them
+    assert 0 < report.import_ms < report.request_import_ms
+    assert build_lambda.over_budget(report, max_size_kb=1, budget_ms=0.1, request_budget_ms=1e6) == [
+        f'Zip size {report.size_kb + report.layer_size_kb:.0f} KB is over the budget of 1 KB',
+        f'Import time {report.import_ms:.1f} ms is over the budget of 0.1 ms',
+    ]
+
+
+# Prints the import time report and keeps it in .pytest_cache/d/importtime/report.txt.
+# The budget is the build's, or IMPORT_TIME_BUDGET_MS on a machine slower than Lambda.
+def test_import_time(request):
+    times = min((import_profile.profile_imports('lambda_function') for _ in range(3)), key=import_profile.total_ms)
+    report = import_profile.format_report(times)
+    (request.config.cache.mkdir('importtime') / 'report.txt').write_text(report + '\n')
+    print(report)
+    packages = {t.module.partition('.')[0] for t in times}
+    assert 'lambda_function' in packages
+    assert not packages & {'pymyq', 'aiohttp', 'environs', 'dotenv', 'marshmallow', 'cryptography'}
+    assert import_profile.total_ms(times) < float(os.environ.get('IMPORT_TIME_BUDGET_MS',
+                                                                 build_lambda.IMPORT_BUDGET_MS)), report